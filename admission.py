@@ -0,0 +1,146 @@
+import os
+import time
+import threading
+from functools import wraps
+from flask import g, abort, current_app, request
+from database import TimedQueuePool, DB_POOL_SIZE, DB_MAX_OVERFLOW
+from models import db
+
+
+'''
+ADMISSION CONTROL
+Routes decorated with @low_priority (the full lists and search) are turned
+away with 503 and Retry-After while this worker is saturated, before
+their token is verified or a connection is checked out. Writes and
+single-entity reads are always admitted, so they keep their latency while
+the database is slow instead of queueing behind the lists.
+
+A worker is saturated when the request waited more than
+ADMISSION_MAX_QUEUE_MS between the router and the worker, when it serves
+more than ADMISSION_MAX_IN_FLIGHT requests, when a checkout waited more
+than ADMISSION_MAX_POOL_WAIT_MS in the last second or so, or when every
+pooled connection is in use and requests are already queueing for one.
+
+A sync gunicorn worker serves one request at a time, so only the queue
+time, read from the X-Request-Start header the router (Heroku, or nginx
+with `proxy_set_header X-Request-Start "t=${msec}"`) adds, shows it is
+behind. The other signals need GUNICORN_THREADS above 1 or asgi.py.
+'''
+
+ADMISSION_MAX_IN_FLIGHT = int(os.environ.get(
+    'ADMISSION_MAX_IN_FLIGHT', DB_POOL_SIZE + DB_MAX_OVERFLOW))
+ADMISSION_MAX_POOL_WAIT_MS = float(
+    os.environ.get('ADMISSION_MAX_POOL_WAIT_MS', 100))
+ADMISSION_MAX_QUEUE_MS = float(
+    os.environ.get('ADMISSION_MAX_QUEUE_MS', 500))
+ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', 1))
+
+
+class AdmissionController:
+    def __init__(self, max_in_flight=ADMISSION_MAX_IN_FLIGHT,
+                 max_pool_wait_ms=ADMISSION_MAX_POOL_WAIT_MS,
+                 max_queue_ms=ADMISSION_MAX_QUEUE_MS):
+        self.max_in_flight = max_in_flight
+        self.max_pool_wait = max_pool_wait_ms / 1000
+        self.max_queue = max_queue_ms / 1000
+        self.in_flight = 0
+        self.shed = 0
+        self._lock = threading.Lock()
+
+    def enter(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def saturated(self, pools, queued=0.0):
+        if self.max_queue and queued > self.max_queue:
+            return True
+        if self.max_in_flight and self.in_flight > self.max_in_flight:
+            return True
+        for pool in pools:
+            if not isinstance(pool, TimedQueuePool):
+                continue
+            if pool.recent_wait() > self.max_pool_wait:
+                return True
+            if pool.waiting and \
+                    pool.checkedout() >= pool.size() + pool._max_overflow:
+                return True
+        return False
+
+    def admit(self, pools, queued=0.0):
+        # False when a low priority request should be shed
+        if not self.saturated(pools, queued):
+            return True
+        with self._lock:
+            self.shed += 1
+        return False
+
+    def stats(self):
+        return {'in_flight': self.in_flight, 'shed': self.shed}
+
+
+admission = AdmissionController()
+
+
+def pools():
+    # The primary's pool and every replica's
+    engines = [db.engine] + current_app.extensions['db_replicas'].engines
+    return [engine.pool for engine in engines]
+
+
+def queue_time(headers):
+    '''
+    Seconds since the router received the request, from X-Request-Start
+    in seconds, milliseconds or microseconds, optionally after "t=".
+    0 without the header.
+    '''
+    value = headers.get('X-Request-Start', '')
+    if value.startswith('t='):
+        value = value[2:]
+    try:
+        started = float(value)
+    except ValueError:
+        return 0.0
+    # Tell the unit from the size of the timestamp
+    if started > 1e14:
+        started /= 1e6
+    elif started > 1e11:
+        started /= 1e3
+    return max(time.time() - started, 0.0)
+
+
+def shed(when=None):
+    # True when the current request is low priority and should be shed
+    return (when is None or when()) and not admission.admit(
+        pools(), queue_time(request.headers))
+
+
+def low_priority(when=None):
+    '''
+    Sheds the route under load. when() may narrow it down to some
+    requests, e.g. only the unfiltered list.
+    '''
+    def low_priority_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if shed(when):
+                abort(503)
+            return f(*args, **kwargs)
+
+        return wrapper
+    return low_priority_decorator
+
+
+def setup_admission(app):
+    @app.before_request
+    def enter_request():
+        admission.enter()
+        g.admission_entered = True
+
+    @app.teardown_request
+    def leave_request(exc):
+        if g.pop('admission_entered', False):
+            admission.leave()
@@ -1,20 +1,63 @@
 import os
+import time
+from itertools import islice
+# Boot time is reported from the first line of this import
+IMPORT_STARTED = time.perf_counter()
 from flask import (
     Flask,
+    Response,
     request,
     jsonify,
-    abort
+    abort,
+    stream_with_context
 )
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from models import setup_db, Nutritionist, Client, Subscription, Article, db
+from models import setup_db, Nutritionist, Client, Subscription, Article, ClientFeed, Rating, OutboxEvent, db
 from datetime import datetime
+from sqlalchemy.exc import IntegrityError, DataError
 from auth.auth import AuthError, requires_auth
+from pagination import page_args, paginate
+from projection import field_args, load_fields
+from search import search_args, search_query
+from bulk import bulk_items, bulk_create, bulk_id, valid_id, text_check, \
+    BULK_CHUNK_SIZE
+from conditional import conditional
+from compression import compress_response
+from serialization import JSONEncoder, dumps, json_response, serialize_rows
+from database import pool_stats
+from replicas import read_replica, pin_after_write
+from metrics import setup_metrics, render as render_metrics
+from profiler import setup_profiler
+from admission import (
+    setup_admission, low_priority, admission, ADMISSION_RETRY_AFTER)
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+# Column each leaderboard is ranked by
+LEADERBOARDS = {
+    'rating': Nutritionist.rating_average,
+    'subscribers': Nutritionist.subscriber_count
+}
+# Rows fetched per round trip when streaming from a server-side cursor
+STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', 500))
+IMPORT_MS = (time.perf_counter() - IMPORT_STARTED) * 1000
+
+
+def full_article_list():
+    # GET /articles without client_id or nutritionist_id
+    return not request.args.get('client_id') and \
+        not request.args.get('nutritionist_id')
 
 
 def create_app(test_config=None):
     # create and configure the app
+    started = time.perf_counter()
     app = Flask(__name__)
+    app.json_encoder = JSONEncoder
+    # First, so its timer wraps every other hook
+    setup_metrics(app)
+    setup_profiler(app)
+    setup_admission(app)
     setup_db(app)
     CORS(app)
 
@@ -25,13 +68,30 @@ def create_app(test_config=None):
                              'Content-Type, Authorization, true')
         response.headers.add('Access-Control-Allow-Methods',
                              'GET, POST, PATCH, DELETE, OPTIONS')
-        return response
+        return compress_response(pin_after_write(response))
 
     @app.route('/')
     def get_initial():
         return jsonify({
             'val': 'Halos'
         })
+
+    # Connection pool usage of this worker
+    @app.route('/pool')
+    def get_pool_stats():
+        return jsonify({
+            'success': True,
+            'data': pool_stats(db.engine),
+            'replicas': [pool_stats(engine) for engine
+                         in app.extensions['db_replicas'].engines],
+            'admission': admission.stats()
+        })
+
+    # Prometheus metrics of every worker sharing METRICS_DIR
+    @app.route('/metrics')
+    def get_metrics():
+        return Response(render_metrics(),
+                        mimetype='text/plain; version=0.0.4')
         
         
 
@@ -42,16 +102,21 @@ def create_app(test_config=None):
 
     # View all nutritionist
     @app.route('/nutritionists', methods=['GET'])
+    @low_priority()
     @requires_auth('view:nutritionist')
+    @read_replica
+    @conditional(['nutritionists'])
     def get_all_nutritionist(jwt):
+        limit, cursor = page_args((Nutritionist.id,))
         try:
-            qr = Nutritionist.query.with_entities(
-                Nutritionist.id, Nutritionist.name).all()
-            nutritionists = [{'id': user.id, 'name': user.name}
-                                 for user in qr] if qr else []
-            return jsonify({
+            qr, next_cursor = paginate(
+                Nutritionist.query.with_entities(
+                    Nutritionist.id, Nutritionist.name),
+                (Nutritionist.id,), limit, cursor)
+            return json_response({
                 'success': True,
-                'data': nutritionists
+                'data': serialize_rows(qr, ('id', 'name')),
+                'next_cursor': next_cursor
             })
         except Exception as e:
             abort(404)
@@ -90,6 +155,23 @@ def create_app(test_config=None):
             abort(422)
             
         
+    # Create nutritionists in bulk
+    @app.route('/nutritionists/bulk', methods=['POST'])
+    @requires_auth('create:nutritionist')
+    def create_nutritionists_bulk(jwt):
+        return bulk_create(
+            bulk_items(), Nutritionist.__table__,
+            ('name', 'specialization', 'email'),
+            lambda item: {
+                'name': item['name'],
+                'specialization': item['specialization'],
+                'email': item['email'],
+                'rating': 0
+            },
+            check=text_check(Nutritionist.__table__,
+                             ('name', 'specialization', 'email')))
+
+
     # Update nutritionist
     @app.route('/nutritionists', methods=['PATCH'])
     @requires_auth('edit:nutritionist')
@@ -100,16 +182,13 @@ def create_app(test_config=None):
             nutritionist = Nutritionist.query.get(id)
 
             if nutritionist:
-                if data.get('rating'):
-                    nutritionist.rating = data.get('rating') if data.get(
-                        'rating') else nutritionist.rating
-                else:
-                    nutritionist.name = data.get('name') if data.get(
-                        'name') else nutritionist.name
-                    nutritionist.specialization = data.get('specialization') if data.get(
-                        'specialization') else nutritionist.name
-                    nutritionist.email = data.get('email') if data.get(
-                        'email') else nutritionist.email
+                # rating is derived from client ratings, see POST /ratings
+                nutritionist.name = data.get('name') if data.get(
+                    'name') else nutritionist.name
+                nutritionist.specialization = data.get('specialization') if data.get(
+                    'specialization') else nutritionist.specialization
+                nutritionist.email = data.get('email') if data.get(
+                    'email') else nutritionist.email
 
                 nutritionist.update()
                 return jsonify({
@@ -127,16 +206,46 @@ def create_app(test_config=None):
             abort(422)
      
             
+    # Top nutritionists by average rating or by subscribers
+    @app.route('/nutritionists/top')
+    @low_priority()
+    @requires_auth('view:nutritionist')
+    @read_replica
+    @conditional(['nutritionists', 'subscriptions'])
+    def get_top_nutritionists(jwt):
+        by = request.args.get('by', 'rating')
+        if by not in LEADERBOARDS:
+            abort(422)
+        # Keyset on (score, id), walking the ranking index from the top
+        order = (LEADERBOARDS[by], Nutritionist.id)
+        limit, cursor = page_args(order)
+        keys = ('id', 'name', 'specialization', 'rating', 'rating_average',
+                'rating_count', 'subscriber_count')
+        qr, next_cursor = paginate(
+            Nutritionist.query.with_entities(
+                *[getattr(Nutritionist, key) for key in keys]),
+            order, limit, cursor, descending=True)
+        return json_response({
+            'success': True,
+            'by': by,
+            'data': serialize_rows(qr, keys),
+            'next_cursor': next_cursor
+        })
+
+
     # Get specific nutritionist
     @app.route('/nutritionists/<int:id>')
     @requires_auth('view:nutritionist')
+    @read_replica
+    @conditional(lambda id: ['nutritionists:{}'.format(id)])
     def get_nutritionist(jwt, id):
+        fields = field_args(Nutritionist)
         try:
-            qr = Nutritionist.query.get(id)
+            qr = load_fields(Nutritionist.query, Nutritionist, fields).get(id)
             if qr:
                 return jsonify({
                     'success': True,
-                    'data': qr.format()
+                    'data': qr.format(fields)
                 })
             else:
                 abort(404)
@@ -156,15 +265,20 @@ def create_app(test_config=None):
 
     # Get all clients
     @app.route('/clients', methods=['GET'])
+    @low_priority()
     @requires_auth('view:client')
+    @read_replica
+    @conditional(['clients'])
     def get_all_client(jwt):
+        limit, cursor = page_args((Client.id,))
         try:
-            qr = Client.query.with_entities(Client.id, Client.name).all()
-            clients = [{'id': user.id, 'name': user.name}
-                        for user in qr] if qr else []
-            return jsonify({
+            qr, next_cursor = paginate(
+                Client.query.with_entities(Client.id, Client.name),
+                (Client.id,), limit, cursor)
+            return json_response({
                 'success': True,
-                'data': clients
+                'data': serialize_rows(qr, ('id', 'name')),
+                'next_cursor': next_cursor
             })
 
         except Exception as e:
@@ -201,6 +315,21 @@ def create_app(test_config=None):
                 
                 
     
+    # Create clients in bulk
+    @app.route('/clients/bulk', methods=['POST'])
+    @requires_auth('create:client')
+    def create_clients_bulk(jwt):
+        return bulk_create(
+            bulk_items(), Client.__table__,
+            ('name', 'country', 'email'),
+            lambda item: {
+                'name': item['name'],
+                'country': item['country'],
+                'email': item['email']
+            },
+            check=text_check(Client.__table__, ('name', 'country', 'email')))
+
+
     # Update Client    
     @app.route('/clients', methods=['PATCH'])
     @requires_auth('edit:client')
@@ -236,13 +365,16 @@ def create_app(test_config=None):
     # Get specific client
     @app.route('/clients/<int:id>')
     @requires_auth('view:client')
+    @read_replica
+    @conditional(lambda id: ['clients:{}'.format(id)])
     def get_client(jwt, id):
+        fields = field_args(Client)
         try:
-            qr = Client.query.get(id)
+            qr = load_fields(Client.query, Client, fields).get(id)
             if qr:
                 return jsonify({
                     'success': True,
-                    'data': qr.format()
+                    'data': qr.format(fields)
                 })
             else:
                 abort(404)
@@ -260,26 +392,65 @@ def create_app(test_config=None):
     Create, Update, Edit, Delete articles
     '''
 
+    def wants_ndjson():
+        return request.accept_mimetypes.best_match(
+            ['application/json', NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+    def article_columns(keys):
+        # Column tuples instead of ORM objects: the keys to serialize plus
+        # the keyset
+        names = dict.fromkeys(keys + ('date_created', 'id'))
+        return Article.query.with_entities(
+            *[getattr(Article, name) for name in names])
+
+    def stream_articles(keys):
+        # Server-side cursor: rows are fetched in batches while the response
+        # is being written, so memory stays flat however many articles exist
+        qr = article_columns(keys).order_by(
+            Article.date_created.desc(), Article.id.desc()
+        ).execution_options(stream_results=True).yield_per(STREAM_BATCH_SIZE)
+        rows = iter(qr)
+        # One chunk per batch, which compression flushes as it goes
+        while True:
+            batch = list(islice(rows, STREAM_BATCH_SIZE))
+            if not batch:
+                break
+            yield b''.join(dumps(row) + b'\n'
+                           for row in serialize_rows(batch, keys))
+
     '''
         View articles created by nutritionist by passing nutritionist_id as params
         View articles subscribed by clients by passing client_id as params
     '''
     @app.route('/articles')
+    # A client's feed and an author's articles are still served under load
+    @low_priority(full_article_list)
     @requires_auth('read:article')
+    @read_replica
+    @conditional(['articles', 'subscriptions'])
     def get_articles(jwt):
         client_id = request.args.get('client_id')
         nutritionist_id = request.args.get('nutritionist_id')
+        # Newest first, keyset on (date_created, id)
+        order = (Article.date_created, Article.id)
+        limit, cursor = page_args(order)
+        keys = tuple(field_args(Article) or Article.DEFAULT_FIELDS)
+        # Only the requested columns, plus the keyset, are selected
+        articles = article_columns(keys)
         if client_id:
             try:
-                qr = Article.query.join(Nutritionist).join(Subscription).join(Client).filter(
-                    Article.nutritionist_id == Subscription.nutritionist_id,
-                    Client.id == Subscription.client_id,
-                    Subscription.client_id == client_id
-                ).all()
-                result = [article.format() for article in qr] if qr else []
-                return jsonify({
+                # The feed is written on article and subscription inserts,
+                # so this is one range scan on the client's feed index
+                qr, next_cursor = paginate(
+                    articles.join(ClientFeed, ClientFeed.article_id == Article.id).filter(
+                        ClientFeed.client_id == client_id
+                    ), (ClientFeed.date_created, ClientFeed.article_id),
+                    limit, cursor, descending=True,
+                    key=lambda article: (article.date_created, article.id))
+                return json_response({
                     'success': True,
-                    'data': result
+                    'data': serialize_rows(qr, keys),
+                    'next_cursor': next_cursor
                 })
             except Exception:
                 abort(404)
@@ -290,15 +461,15 @@ def create_app(test_config=None):
 
         if nutritionist_id:
             try:
-                qr = Article.query.join(Nutritionist).filter(
-                    Article.nutritionist_id == Nutritionist.id,
-                    Nutritionist.id == nutritionist_id
-                ).all()
+                qr, next_cursor = paginate(
+                    articles.filter(
+                        Article.nutritionist_id == nutritionist_id
+                    ), order, limit, cursor, descending=True)
 
-                result = [article.format() for article in qr] if qr else []
-                return jsonify({
+                return json_response({
                     'success': True,
-                    'data': result
+                    'data': serialize_rows(qr, keys),
+                    'next_cursor': next_cursor
                 })
             except Exception as e:
                 abort(404)
@@ -307,14 +478,19 @@ def create_app(test_config=None):
                     'message': 'data not found'
                 }), 404
 
+        elif wants_ndjson():
+            # Stream every article, one JSON document per line
+            return Response(stream_with_context(stream_articles(keys)),
+                            mimetype=NDJSON_MIMETYPE)
+
         else:
             try:
-                qr = Article.query.all()
-                formated_data = [article.format()
-                                for article in qr] if qr else []
-                return jsonify({
+                qr, next_cursor = paginate(
+                    articles, order, limit, cursor, descending=True)
+                return json_response({
                     'success': True,
-                    'data': formated_data
+                    'data': serialize_rows(qr, keys),
+                    'next_cursor': next_cursor
                 })
             except Exception as e:
                 abort(404)
@@ -324,6 +500,42 @@ def create_app(test_config=None):
                 }), 404
                 
                 
+    # Search article titles and content, best matches first
+    @app.route('/articles/search')
+    @low_priority()
+    @requires_auth('read:article')
+    @read_replica
+    @conditional(['articles'])
+    def search_articles(jwt):
+        q = search_args()
+        nutritionist_id = request.args.get('nutritionist_id')
+        keys = tuple(field_args(Article) or Article.DEFAULT_FIELDS)
+        articles, rank = search_query(article_columns(keys), q)
+        # Keyset on (rank, id): pages never skip rows or repeat them, but
+        # every page still ranks and sorts all matches of q
+        order = (rank, Article.id)
+        limit, cursor = page_args(order)
+        if nutritionist_id:
+            articles = articles.filter(
+                Article.nutritionist_id == nutritionist_id)
+        try:
+            qr, next_cursor = paginate(
+                articles.add_columns(rank.label('rank')), order, limit,
+                cursor, descending=True,
+                key=lambda article: (article.rank, article.id))
+            return json_response({
+                'success': True,
+                'data': serialize_rows(qr, keys),
+                'next_cursor': next_cursor
+            })
+        except Exception:
+            abort(404)
+            return jsonify({
+                'success': False,
+                'message': 'data not found'
+            }), 404
+
+
     # Create articles
     @app.route('/articles', methods=['POST'])
     @requires_auth('create:article')
@@ -362,6 +574,42 @@ def create_app(test_config=None):
                 abort(422)
                 
                 
+    # Create articles in bulk
+    @app.route('/articles/bulk', methods=['POST'])
+    @requires_auth('create:article')
+    def create_articles_bulk(jwt):
+        items = bulk_items()
+        # One IN query checks every author in the batch
+        author_ids = {bulk_id(item.get('nutritionist')) for item in items
+                      if isinstance(item, dict)} - {None}
+        authors = {author.id for author in Nutritionist.query.with_entities(
+            Nutritionist.id).filter(Nutritionist.id.in_(author_ids))}
+        date_created = datetime.now()
+
+        def check(item):
+            # Per item, so one bad item doesn't fail the whole batch
+            if not isinstance(item['title'], str) or \
+                    not isinstance(item['content'], str):
+                return 'title and content must be text'
+            if len(item['title']) > Article.title.type.length:
+                return 'title is too long'
+            if bulk_id(item['nutritionist']) not in authors:
+                return 'Nutritionist selected not found.'
+
+        return bulk_create(
+            items, Article.__table__,
+            ('title', 'content', 'nutritionist'),
+            lambda item: {
+                'title': item['title'],
+                'content': item['content'],
+                'nutritionist_id': bulk_id(item['nutritionist']),
+                'date_created': date_created
+            },
+            check=check,
+            after_insert=lambda ids: OutboxEvent.publish(
+                'articles.created', ids=ids))
+
+
     # Update articles
     @app.route('/articles', methods=['PATCH'])
     @requires_auth('edit:article')
@@ -418,6 +666,44 @@ def create_app(test_config=None):
             abort(422)
 
     
+    '''
+    Rate a nutritionist
+    Post with client_id, nutritionist_id and a score from 1 to 5
+    '''
+
+    @app.route('/ratings', methods=['POST'])
+    @requires_auth('rate:nutritionist')
+    def rate_nutritionist(jwt):
+        data = request.get_json()
+        nutritionist_id = data.get('nutritionist_id')
+        client_id = data.get('client_id')
+        score = data.get('score')
+
+        if not nutritionist_id or not client_id or score is None:
+            abort(412)
+        if not isinstance(score, int) or isinstance(score, bool) or \
+                not Rating.MIN_SCORE <= score <= Rating.MAX_SCORE:
+            abort(422)
+
+        try:
+            created = Rating.rate(nutritionist_id, client_id, score)
+        except (IntegrityError, DataError):
+            db.session.rollback()
+            abort(412)
+            return jsonify({
+                'success': False,
+                'message': 'provide accurate data for required fields'
+            }), 412
+        except Exception:
+            db.session.rollback()
+            abort(422)
+
+        return jsonify({
+            'success': True,
+            'created': created,
+            'message': 'Rating saved'
+        })
+
     '''
     Subscribe Client to nutritionist
     Post with client_id and nutritionist_id
@@ -435,38 +721,76 @@ def create_app(test_config=None):
             client_id = data.get('client_id')
             subscription_status = True
             
-            check_nutritionist = Nutritionist.query.get(nutritionist_id)
-            check_client = Client.query.get(client_id)
-            
-            subscription_check = Subscription.query.filter(
-                Subscription.client_id == client_id, Subscription.nutritionist_id == nutritionist_id).all()
+            if not nutritionist_id or not client_id or not subscription_status:
+                abort(412)
 
-            if not check_nutritionist or not check_client or not subscription_status:
+            # One INSERT ... ON CONFLICT DO NOTHING: the foreign keys reject
+            # unknown ids and the unique index rejects duplicates
+            try:
+                created = Subscription.subscribe(
+                    nutritionist_id, client_id, subscription_status)
+            except (IntegrityError, DataError):
+                db.session.rollback()
                 abort(412)
                 return jsonify({
                     'success': False,
                     'message': 'provide accurate data for required fields'
                 }), 412
-            elif subscription_check:
+            except Exception:
+                db.session.rollback()
+                abort(422)
+
+            if not created:
                 abort(422)
                 return jsonify({
                     'success': False,
                     'message': 'Client already subscribed to this nutritionist'
                 }), 422
-            else:
-                try:
-                    subscription = Subscription(
-                        nutritionist_id=nutritionist_id, client_id=client_id, subscription_status=subscription_status)
-                    subscription.insert()
 
-                    return jsonify({
-                        'success': True,
-                        'message': 'Client subscription added'
-                    })
+            return jsonify({
+                'success': True,
+                'message': 'Client subscription added'
+            })
+
+    # Subscribe many clients to nutritionists at once
+    @app.route('/subscriptions/bulk', methods=['POST'])
+    @requires_auth('subscribe:client')
+    def subscription_bulk(jwt):
+        items = bulk_items()
+        # Only integer ids (not True) can match; the rest count as invalid
+        pairs = [(valid_id(item.get('client_id')),
+                  valid_id(item.get('nutritionist_id')))
+                 if isinstance(item, dict) else (None, None)
+                 for item in items]
+
+        # Set based validation: one IN query per table
+        client_ids = {client_id for client_id, _ in pairs} - {None}
+        nutritionist_ids = {nutritionist_id for _, nutritionist_id
+                            in pairs} - {None}
+        clients = {row.id for row in Client.query.with_entities(
+            Client.id).filter(Client.id.in_(client_ids))}
+        nutritionists = {row.id for row in Nutritionist.query.with_entities(
+            Nutritionist.id).filter(Nutritionist.id.in_(nutritionist_ids))}
+
+        valid = list(dict.fromkeys(
+            pair for pair in pairs
+            if pair[0] in clients and pair[1] in nutritionists))
+        invalid = sum(1 for pair in pairs
+                      if pair[0] not in clients or pair[1] not in nutritionists)
+
+        try:
+            created = Subscription.subscribe_many(valid, BULK_CHUNK_SIZE)
+        except Exception:
+            db.session.rollback()
+            abort(422)
+
+        return jsonify({
+            'success': True,
+            'created': created,
+            'duplicate': len(pairs) - invalid - created,
+            'invalid': invalid
+        })
 
-                except Exception:
-                    abort(422)
-                    
     '''
         HANDLE APP ERRORS
     '''
@@ -511,6 +835,15 @@ def create_app(test_config=None):
             'message': 'internal server error'
         }), 500
 
+    # Shed by admission control, see admission.py
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        return jsonify({
+            'success': False,
+            'error': 503,
+            'message': 'service unavailable'
+        }), 503, {'Retry-After': str(ADMISSION_RETRY_AFTER)}
+
         
     @app.errorhandler(AuthError)
     def handle_auth_error(ex):
@@ -518,10 +851,32 @@ def create_app(test_config=None):
         response.status_code = ex.status_code
         return response
 
+    app.config['BOOT_TIME_MS'] = {
+        'import': round(IMPORT_MS, 1),
+        'create_app': round((time.perf_counter() - started) * 1000, 1)
+    }
+    app.logger.info('app booted: %s', app.config['BOOT_TIME_MS'])
     return app
 
 
-app = create_app()
+_app = None
+
+
+def get_app():
+    global _app
+    if _app is None:
+        _app = create_app()
+    return _app
+
+
+def __getattr__(name):
+    # `app:app` (gunicorn, flask run, manage.py) builds the app on first
+    # access instead of at import time
+    if name == 'app':
+        return get_app()
+    raise AttributeError('module {!r} has no attribute {!r}'.format(
+        __name__, name))
+
 
 if __name__ == '__main__':
-    app.run()
+    get_app().run()
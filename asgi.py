@@ -0,0 +1,306 @@
+import io
+import os
+import sys
+import time
+import asyncio
+from flask import request, make_response
+from a2wsgi import WSGIMiddleware
+from werkzeug.exceptions import ServiceUnavailable
+from app import get_app, full_article_list, NDJSON_MIMETYPE
+from models import Nutritionist, Client, Article, ResourceVersion
+from auth.auth import (
+    get_token_auth_header,
+    verify_decode_jwt,
+    check_permissions,
+    token_cache
+)
+from async_database import (
+    AsyncDatabase,
+    ASYNC_DATABASE_URL,
+    ASYNC_DB_POOL_SIZE
+)
+from conditional import validators, not_modified, tag_response
+from pagination import page_args, encode_cursor
+from projection import field_args
+from serialization import json_response, serialize_records
+from metrics import start_timer, end_timer, add_time
+from admission import admission, shed
+
+
+'''
+ASGI ENTRY POINT
+uvicorn asgi:app serves the same API as create_app() from one event loop.
+The list routes (GET /nutritionists, /clients and /articles) run natively:
+token verification, and with it any JWKS fetch, runs in a thread, queries
+go to an async connection pool, and Flask still builds the response so its
+headers and body match the WSGI app byte for byte. Every other request,
+and any request the native path would answer differently (a bad token,
+invalid arguments, NDJSON streaming), is passed to the WSGI app running in
+a thread pool. Native routes are shed under load like their WSGI ones.
+'''
+
+ASGI_WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', 10))
+
+
+class Fallback(Exception):
+    # The WSGI app answers this request
+    pass
+
+
+class Query:
+    # SELECT text with $n placeholders, built up clause by clause
+    def __init__(self, sql):
+        self.sql = sql
+        self.params = []
+
+    def param(self, value):
+        self.params.append(value)
+        return '${}'.format(len(self.params))
+
+
+def wsgi_environ(scope):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode(
+            'utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+    return environ
+
+
+class AsyncApp:
+    def __init__(self, flask_app=None, database=None):
+        self.flask_app = flask_app or get_app()
+        self.wsgi = WSGIMiddleware(self.flask_app, workers=ASGI_WSGI_THREADS)
+        self.db = database or AsyncDatabase(
+            ASYNC_DATABASE_URL, ASYNC_DB_POOL_SIZE)
+        self.routes = {
+            # path: (permission, plan, when the route is low priority)
+            '/nutritionists': ('view:nutritionist', self.nutritionists, None),
+            '/clients': ('view:client', self.clients, None),
+            '/articles': ('read:article', self.articles, full_article_list)
+        }
+        self._connected = False
+        self._connect_lock = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+
+        route = None
+        if scope['type'] == 'http' and scope['method'] == 'GET' and \
+                self.db.available:
+            route = self.routes.get(scope['path'])
+        if route is not None:
+            admission.enter()
+            try:
+                response = await self.handle(wsgi_environ(scope), *route)
+            except Exception:
+                response = None
+            finally:
+                # A request falling back is counted by the WSGI app instead
+                admission.leave()
+                end_timer()
+            if response is not None:
+                return await self.send_response(send, response)
+        await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                if self.db.available:
+                    await self.connect()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.db.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def connect(self):
+        if self._connect_lock is None:
+            # Created on the server's loop, not at import
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if not self._connected:
+                await self.db.connect()
+                self._connected = True
+
+    async def handle(self, environ, permission, plan, low_priority):
+        if not self._connected:
+            await self.connect()
+
+        # Flask's request context only ever lives between two awaits, so
+        # concurrent requests on the loop thread never see each other's
+        with self.flask_app.request_context(environ):
+            # Counted under the same endpoint as the WSGI route
+            start_timer(request.url_rule.endpoint, request.method,
+                        hooks=False)
+            if shed(low_priority):
+                # The same 503 and Retry-After as @low_priority
+                return self.flask_app.process_response(
+                    self.flask_app.make_response(
+                        self.flask_app.handle_http_exception(
+                            ServiceUnavailable())))
+            started = time.perf_counter()
+            token = get_token_auth_header()
+            cached = token_cache.get(token)
+        if cached:
+            payload, permissions = cached
+        else:
+            payload = await asyncio.get_running_loop().run_in_executor(
+                None, verify_decode_jwt, token)
+            permissions = token_cache.put(token, payload)
+        check_permissions(permission, payload, permissions)
+        add_time('auth', time.perf_counter() - started)
+
+        with self.flask_app.request_context(environ):
+            version_keys, query, keys, cursor_of = plan()
+        started = time.perf_counter()
+        versions = await self.versions(version_keys)
+        add_time('db', time.perf_counter() - started)
+
+        with self.flask_app.request_context(environ):
+            etag, last_modified = validators(versions)
+            matched = not_modified(etag, last_modified)
+            if matched:
+                return self.finish(make_response('', 304),
+                                   matched, last_modified)
+        started = time.perf_counter()
+        rows = await self.db.fetch(query.sql, *query.params)
+        add_time('db', time.perf_counter() - started)
+
+        with self.flask_app.request_context(environ):
+            # The query asked for one row more than the page
+            limit = query.params[-1] - 1
+            next_cursor = None
+            if len(rows) > limit:
+                rows = rows[:limit]
+                next_cursor = encode_cursor(cursor_of(rows[-1]))
+            return self.finish(json_response({
+                'success': True,
+                'data': serialize_records(rows, keys),
+                'next_cursor': next_cursor
+            }), etag, last_modified)
+
+    def finish(self, response, etag, last_modified):
+        # Same after_request hooks (CORS, compression) as the WSGI app
+        response = tag_response(response, etag, last_modified)
+        return self.flask_app.process_response(response)
+
+    async def versions(self, keys):
+        # ResourceVersion.current on the async pool
+        query = Query('SELECT key, version, updated_at FROM resource_versions')
+        query.sql += ' WHERE key IN ({})'.format(
+            ', '.join(query.param(key)
+                      for key in ResourceVersion.slot_keys(keys)))
+        return ResourceVersion.combine(keys, [
+            (row['key'], row['version'], row['updated_at'])
+            for row in await self.db.fetch(query.sql, *query.params)])
+
+    @staticmethod
+    async def send_response(send, response):
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': [(name.lower().encode('latin-1'),
+                         value.encode('latin-1'))
+                        for name, value in response.headers.items()]
+        })
+        await send({'type': 'http.response.body',
+                    'body': response.get_data()})
+
+    '''
+    ROUTE PLANS
+    Each runs inside a request context and returns the version keys the
+    route depends on, its page query, the keys to serialize and a function
+    giving a row's cursor values. Arguments are validated with the same
+    helpers as the WSGI routes, so anything they reject falls back.
+    '''
+
+    def nutritionists(self):
+        return (['nutritionists'],) + self.id_page(Nutritionist)
+
+    def clients(self):
+        return (['clients'],) + self.id_page(Client)
+
+    @staticmethod
+    def id_page(model):
+        limit, cursor = page_args((model.id,))
+        query = Query('SELECT id, name FROM ' + model.__tablename__)
+        if cursor:
+            query.sql += ' WHERE id > ' + query.param(cursor[0])
+        query.sql += ' ORDER BY id LIMIT ' + query.param(limit + 1)
+        return query, ('id', 'name'), lambda row: [row['id']]
+
+    def articles(self):
+        client_id = request.args.get('client_id')
+        nutritionist_id = request.args.get('nutritionist_id')
+        limit, cursor = page_args((Article.date_created, Article.id))
+        keys = tuple(field_args(Article) or Article.DEFAULT_FIELDS)
+        columns = ', '.join('a.' + name for name in
+                            dict.fromkeys(keys + ('date_created', 'id')))
+
+        if client_id:
+            # Page the client's feed, as get_articles does
+            query = Query(
+                'SELECT {} FROM articles a JOIN client_feed f '
+                'ON f.article_id = a.id WHERE f.client_id = '.format(columns))
+            query.sql += query.param(self.integer(client_id))
+            order = ('f.date_created', 'f.article_id')
+        else:
+            if not nutritionist_id and request.accept_mimetypes.best_match(
+                    ['application/json', NDJSON_MIMETYPE]) == NDJSON_MIMETYPE:
+                raise Fallback('NDJSON is streamed by the WSGI app')
+            query = Query('SELECT {} FROM articles a WHERE 1 = 1'.format(
+                columns))
+            if nutritionist_id:
+                query.sql += ' AND a.nutritionist_id = ' + query.param(
+                    self.integer(nutritionist_id))
+            order = ('a.date_created', 'a.id')
+
+        if cursor:
+            query.sql += ' AND ({}, {}) < ({}, {})'.format(
+                order[0], order[1],
+                query.param(cursor[0]), query.param(cursor[1]))
+        query.sql += ' ORDER BY {} DESC, {} DESC LIMIT {}'.format(
+            order[0], order[1], query.param(limit + 1))
+        return (['articles', 'subscriptions'], query, keys,
+                lambda row: [row['date_created'], row['id']])
+
+    @staticmethod
+    def integer(value):
+        try:
+            return int(value)
+        except ValueError:
+            raise Fallback(value)
+
+
+def __getattr__(name):
+    # `uvicorn asgi:app` builds the app on first access, like app.py
+    if name == 'app':
+        global app
+        app = AsyncApp()
+        return app
+    raise AttributeError('module {!r} has no attribute {!r}'.format(
+        __name__, name))
@@ -0,0 +1,85 @@
+import os
+import sqlite3
+from datetime import datetime
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+try:
+    import aiosqlite
+except ImportError:
+    aiosqlite = None
+
+
+'''
+ASYNC DATABASE
+Connection pool for the asyncio entry point (asgi.py). Queries are written
+with $1, $2 placeholders; PostgreSQL runs them on asyncpg and SQLite (local
+testing) on aiosqlite:
+
+    ASYNC_DATABASE_URL  database for the async routes (default DATABASE_URL)
+    ASYNC_DB_POOL_SIZE  connections per process (default 20)
+'''
+
+ASYNC_DATABASE_URL = os.environ.get(
+    'ASYNC_DATABASE_URL', os.environ.get('DATABASE_URL', ''))
+ASYNC_DB_POOL_SIZE = int(os.environ.get('ASYNC_DB_POOL_SIZE', 20))
+# SQLAlchemy's storage format for SQLite DateTime columns
+SQLITE_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def parse_sqlite_datetime(value):
+    return datetime.fromisoformat(value.decode('utf-8'))
+
+
+class AsyncDatabase:
+    def __init__(self, url, pool_size=20):
+        self.url = url
+        self.pool_size = pool_size
+        self.dialect = 'sqlite' if url.startswith('sqlite') else 'postgresql'
+        self._pool = None
+        self._connection = None
+
+    @property
+    def available(self):
+        return (aiosqlite if self.dialect == 'sqlite' else asyncpg) is not None
+
+    async def connect(self):
+        if self.dialect == 'sqlite':
+            sqlite3.register_converter('DATETIME', parse_sqlite_datetime)
+            self._connection = await aiosqlite.connect(
+                self.url.split(':///', 1)[1],
+                detect_types=sqlite3.PARSE_DECLTYPES)
+            self._connection.row_factory = sqlite3.Row
+        else:
+            # postgresql+psycopg2://... is a SQLAlchemy URL, asyncpg wants
+            # a plain DSN
+            scheme, rest = self.url.split('://', 1)
+            self._pool = await asyncpg.create_pool(
+                'postgresql://' + rest, min_size=1, max_size=self.pool_size)
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+        if self._connection is not None:
+            await self._connection.close()
+
+    async def fetch(self, sql, *args):
+        # Returns rows whose columns can be read by name
+        if self.dialect == 'sqlite':
+            cursor = await self._connection.execute(
+                sql.replace('$', '?'), [self._sqlite_param(arg)
+                                        for arg in args])
+            rows = await cursor.fetchall()
+            await cursor.close()
+            return rows
+        return await self._pool.fetch(sql, *args)
+
+    @staticmethod
+    def _sqlite_param(value):
+        if isinstance(value, datetime):
+            # Compare as the same text SQLAlchemy stored
+            return value.strftime(SQLITE_DATETIME_FORMAT)
+        return value
@@ -1,20 +1,47 @@
 import os
 import json
+import time
 from flask import request, _request_ctx_stack, abort
 from functools import wraps
-from jose import jwt
-from urllib.request import urlopen
-from subprocess import call
-import shlex
-
-call(shlex.split('bash setup.sh'))
+from .jwks import JWKSCache
+from .token_cache import TokenCache
+from jose import jwt, jwk
+from metrics import add_time
 
 
 AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN')
 ALGORITHMS = os.environ.get('ALGORITHMS')
 API_AUDIENCE = os.environ.get('API_AUDIENCE')
+JWKS_CACHE_TTL = int(os.environ.get('JWKS_CACHE_TTL', 600))
+JWKS_MIN_REFRESH_INTERVAL = int(
+    os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+JWKS_CACHE_PATH = os.environ.get('JWKS_CACHE_PATH')
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 10000))
 # print(os.environ.get('JWT_TOKEN'))
 
+
+def build_public_key(key):
+    # Parse the modulus and exponent once, when the JWKS is loaded.
+    # python-jose 3.2.0 doesn't take its own Key objects in jwt.decode, but
+    # takes a list of keys and keeps a parsed backend key as it is
+    return [jwk.construct({
+        'kty': key['kty'],
+        'kid': key['kid'],
+        'use': key.get('use', 'sig'),
+        'n': key['n'],
+        'e': key['e']
+    }, algorithm=key.get('alg', 'RS256'))._prepared_key]
+
+
+jwks_cache = JWKSCache(
+    f'https://{AUTH0_DOMAIN}/.well-known/jwks.json',
+    ttl=JWKS_CACHE_TTL,
+    min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+    cache_path=JWKS_CACHE_PATH,
+    key_builder=build_public_key
+)
+token_cache = TokenCache(max_size=TOKEN_CACHE_SIZE)
+
 # AuthError Exception
 '''
 AuthError Exception
@@ -63,7 +90,7 @@ def get_token_auth_header():
     return token
 
 
-def check_permissions(permission, payload):
+def check_permissions(permission, payload, permissions=None):
     # Check if permissions are included in the payload
     if 'permissions' not in payload:
         raise AuthError({
@@ -71,7 +98,10 @@ def check_permissions(permission, payload):
             'description': 'Permissions not included in JWT.'
         }, 400)
 
-    if permission not in payload['permissions']:
+    # permissions is the precomputed set kept by the token cache
+    if permissions is None:
+        permissions = payload['permissions']
+    if permission not in permissions:
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission not found.'
@@ -80,30 +110,19 @@ def check_permissions(permission, payload):
 
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
-    if rsa_key:
+    public_key = jwks_cache.get_key(unverified_header['kid'])
+    if public_key is not None:
         try:
             payload = jwt.decode(
                 token,
-                rsa_key,
+                public_key,
                 algorithms=ALGORITHMS,
                 audience=API_AUDIENCE,
                 issuer='https://' + AUTH0_DOMAIN + '/'
@@ -137,14 +156,22 @@ def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
+            started = time.perf_counter()
             token = get_token_auth_header()
-            try:
-                payload = verify_decode_jwt(token)
-                # print(payload)
-            except:
-                abort(401)
-
-            check_permissions(permission, payload)
+            cached = token_cache.get(token)
+            if cached:
+                payload, permissions = cached
+            else:
+                try:
+                    payload = verify_decode_jwt(token)
+                    # print(payload)
+                except:
+                    abort(401)
+                permissions = token_cache.put(token, payload)
+
+            check_permissions(permission, payload, permissions)
+            _request_ctx_stack.top.current_user = payload
+            add_time('auth', time.perf_counter() - started)
             return f(payload, *args, **kwargs)
 
         return wrapper
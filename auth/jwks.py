@@ -0,0 +1,139 @@
+import os
+import json
+import time
+import threading
+from urllib.request import urlopen
+
+
+'''
+JWKS Cache
+Process-wide cache of the identity provider's signing keys so that
+verifying a token does not cost an outbound HTTPS round trip.
+'''
+
+
+class JWKSCache:
+    def __init__(self, url, ttl=600, min_refresh_interval=30,
+                 cache_path=None, timeout=5, key_builder=None):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.cache_path = cache_path
+        self.timeout = timeout
+        # Turns a JWKS entry into the object handed out by get_key, so key
+        # material is parsed once per load instead of once per request
+        self.key_builder = key_builder
+
+        self._keys = {}
+        self._fetched_at = 0.0
+        self._last_attempt = 0.0
+        self._lock = threading.Lock()
+        self._background_lock = threading.Lock()
+        self._refreshing = False
+
+    # Returns the key for kid, or None when the provider does not know it
+    def get_key(self, kid):
+        if not self._keys:
+            self._load_initial()
+
+        key = self._keys.get(kid)
+        if key is None:
+            # Unknown kid: the keys may have rotated. Refetch, but never more
+            # than once per min_refresh_interval so bad tokens can't storm us.
+            if self._refresh_allowed():
+                self.refresh()
+                key = self._keys.get(kid)
+        elif self._is_stale():
+            self._refresh_in_background()
+        return key
+
+    def refresh(self):
+        with self._lock:
+            # Another thread may have refreshed while we waited on the lock
+            if not self._refresh_allowed():
+                return
+            self._last_attempt = time.time()
+            try:
+                jwks = self._fetch()
+            except Exception:
+                # Keep serving the keys we have if the provider is unreachable
+                return
+            self._swap(jwks, time.time())
+            self._persist(jwks)
+
+    def _load_initial(self):
+        with self._lock:
+            if self._keys:
+                return
+            cached = self._read_disk()
+            if cached:
+                jwks, fetched_at = cached
+                self._swap(jwks, fetched_at)
+        if not self._keys:
+            self.refresh()
+        elif self._is_stale():
+            self._refresh_in_background()
+
+    def _refresh_in_background(self):
+        with self._background_lock:
+            if self._refreshing or not self._refresh_allowed():
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, name='jwks-refresh', daemon=True).start()
+
+    def _refresh_allowed(self):
+        return time.time() - self._last_attempt >= self.min_refresh_interval
+
+    def _is_stale(self):
+        return time.time() - self._fetched_at >= self.ttl
+
+    def _fetch(self):
+        response = urlopen(self.url, timeout=self.timeout)
+        return json.loads(response.read())
+
+    def _swap(self, jwks, fetched_at):
+        # Build the new registry off to the side and replace it in one step,
+        # so a request never sees a half rotated key set
+        keys = {}
+        for key in jwks.get('keys', []):
+            if 'kid' not in key:
+                continue
+            if self.key_builder is None:
+                keys[key['kid']] = key
+                continue
+            try:
+                keys[key['kid']] = self.key_builder(key)
+            except Exception:
+                # Skip entries we can't use, e.g. encryption keys
+                continue
+        self._keys = keys
+        self._fetched_at = fetched_at
+
+    def _read_disk(self):
+        if not self.cache_path:
+            return None
+        try:
+            with open(self.cache_path) as f:
+                jwks = json.load(f)
+            return jwks, os.path.getmtime(self.cache_path)
+        except (OSError, ValueError):
+            return None
+
+    def _persist(self, jwks):
+        if not self.cache_path:
+            return
+        tmp_path = '{}.{}.tmp'.format(self.cache_path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(jwks, f)
+            # Atomic so another worker never reads a half written file
+            os.replace(tmp_path, self.cache_path)
+        except OSError:
+            pass
@@ -0,0 +1,68 @@
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+'''
+Verified Token Cache
+Bounded LRU of already verified JWT payloads. A bearer token that was
+verified once is trusted until its exp claim without decoding it again.
+'''
+
+
+class TokenCache:
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key_for(token):
+        # Never keep raw bearer tokens in memory longer than needed
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    # Returns (payload, permissions) for a cached token, or None
+    def get(self, token):
+        key = self.key_for(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            payload, permissions, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return payload, permissions
+
+    def put(self, token, payload):
+        permissions = frozenset(payload.get('permissions', ()))
+        expires_at = payload.get('exp')
+        if not isinstance(expires_at, (int, float)) or self.max_size <= 0:
+            return permissions
+
+        key = self.key_for(token)
+        with self._lock:
+            self._entries[key] = (payload, permissions, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return permissions
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+            'max_size': self.max_size
+        }
@@ -0,0 +1,120 @@
+'''
+Benchmark of the WSGI app against the ASGI entry point under concurrency.
+
+Starts gunicorn (sync workers, as in the Procfile) and uvicorn (asgi:app)
+on local ports, sends the same GET requests from many concurrent
+connections to each and reports throughput and latency percentiles.
+DATABASE_URL, the Auth0 settings and a JWT_TOKEN with read:article must be
+exported; gunicorn and uvicorn must be installed.
+
+Usage:
+    python benchmarks/bench_asgi.py [concurrency] [requests] [path]
+'''
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import asyncio
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKERS = os.environ.get('WEB_CONCURRENCY', '2')
+SERVERS = {
+    'wsgi': ['gunicorn', '-c', 'gunicorn.conf.py', '--workers', WORKERS,
+             '--bind', '127.0.0.1:{port}', 'app:app'],
+    'asgi': ['uvicorn', '--workers', WORKERS, '--no-access-log',
+             '--host', '127.0.0.1', '--port', '{port}', 'asgi:app']
+}
+
+
+async def get(port, path, token):
+    # One request per connection: sync gunicorn workers close every one
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write((
+        'GET {} HTTP/1.1\r\nHost: 127.0.0.1\r\n'
+        'Authorization: Bearer {}\r\nConnection: close\r\n\r\n'
+    ).format(path, token).encode('latin-1'))
+    await writer.drain()
+    status = (await reader.readline()).split()[1]
+    await reader.read()
+    writer.close()
+    return int(status), time.perf_counter() - start
+
+
+async def load(port, path, token, concurrency, total):
+    latencies = []
+    errors = 0
+    remaining = iter(range(total))
+
+    async def client():
+        nonlocal errors
+        for _ in remaining:
+            try:
+                status, elapsed = await get(port, path, token)
+            except OSError:
+                errors += 1
+                continue
+            if status != 200:
+                errors += 1
+            latencies.append(elapsed)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+
+    def percentile(p):
+        if not latencies:
+            return None
+        return round(latencies[min(len(latencies) - 1,
+                                   int(len(latencies) * p))] * 1000, 2)
+
+    return {
+        'requests': total,
+        'errors': errors,
+        'rps': round(total / elapsed, 1),
+        'p50_ms': percentile(0.50),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99)
+    }
+
+
+def wait_until_listening(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('server on port {} did not start'.format(port))
+
+
+def main():
+    concurrency = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    total = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    path = sys.argv[3] if len(sys.argv) > 3 else '/articles'
+    token = os.environ['JWT_TOKEN']
+
+    results = {'concurrency': concurrency, 'path': path, 'workers': WORKERS}
+    for port, (name, command) in enumerate(sorted(SERVERS.items()), 8701):
+        server = subprocess.Popen(
+            [part.format(port=port) for part in command], cwd=ROOT,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_until_listening(port)
+            # Warm up connections, token caches and JWKS
+            asyncio.run(load(port, path, token, 10, 100))
+            results[name] = asyncio.run(
+                load(port, path, token, concurrency, total))
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
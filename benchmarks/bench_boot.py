@@ -0,0 +1,59 @@
+'''
+Benchmark for worker cold start.
+
+Starts fresh interpreters that import app and build it with get_app(), and
+reports the import time, create_app time and the whole boot as seen from
+outside, against the 200 ms budget for a worker that does not preload.
+DATABASE_URL and the Auth0 settings must be exported, as for the app.
+
+Usage:
+    python benchmarks/bench_boot.py [runs]
+'''
+import os
+import sys
+import json
+import time
+import subprocess
+from statistics import median
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUDGET_MS = 200
+
+BOOT = '''
+import json, time
+started = time.perf_counter()
+import app
+boot = app.get_app().config['BOOT_TIME_MS']
+boot['total'] = round((time.perf_counter() - started) * 1000, 1)
+print(json.dumps(boot))
+'''
+
+
+def boot_once():
+    output = subprocess.check_output(
+        [sys.executable, '-c', BOOT], cwd=ROOT)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    # The first run warms the bytecode and filesystem caches
+    boot_once()
+    start = time.perf_counter()
+    boots = [boot_once() for _ in range(runs)]
+    elapsed = time.perf_counter() - start
+
+    results = {
+        'runs': runs,
+        'import_ms': median(boot['import'] for boot in boots),
+        'create_app_ms': median(boot['create_app'] for boot in boots),
+        'boot_ms': median(boot['total'] for boot in boots),
+        'process_ms': round(elapsed * 1000 / runs, 1),
+        'budget_ms': BUDGET_MS
+    }
+    results['within_budget'] = results['boot_ms'] < BUDGET_MS
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
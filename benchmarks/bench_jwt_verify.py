@@ -0,0 +1,73 @@
+'''
+Micro-benchmark for per-request JWT verification cost.
+
+Compares verifying a token against a plain JWK dict (python-jose parses the
+modulus and exponent on every call, which is what verify_decode_jwt used to
+do) with verifying it against the public key prebuilt by
+auth.auth.build_public_key.
+
+Usage:
+    python benchmarks/bench_jwt_verify.py [iterations]
+'''
+import os
+import sys
+import json
+import time
+import base64
+import timeit
+
+import rsa
+from jose import jwt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from auth.auth import build_public_key  # noqa: E402
+
+
+def b64_uint(value):
+    raw = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    public, private = rsa.newkeys(2048)
+    jwk_dict = {
+        'kty': 'RSA',
+        'kid': 'bench',
+        'use': 'sig',
+        'n': b64_uint(public.n),
+        'e': b64_uint(public.e)
+    }
+    now = int(time.time())
+    token = jwt.encode({
+        'iss': 'https://bench.local/',
+        'aud': 'nutrition_article',
+        'iat': now,
+        'exp': now + 3600,
+        'permissions': ['read:article']
+    }, private.save_pkcs1().decode('ascii'), algorithm='RS256',
+        headers={'kid': 'bench'})
+    public_key = build_public_key(jwk_dict)
+
+    def verify(key):
+        return jwt.decode(token, key, algorithms=['RS256'],
+                          audience='nutrition_article',
+                          issuer='https://bench.local/')
+
+    results = {}
+    for name, key in (('jwk_dict', jwk_dict), ('prebuilt_key', public_key)):
+        verify(key)
+        seconds = min(timeit.repeat(lambda: verify(key), number=iterations,
+                                    repeat=3))
+        results[name] = round(seconds / iterations * 1e6, 2)
+
+    print(json.dumps({
+        'iterations': iterations,
+        'us_per_verify': results,
+        'speedup': round(results['jwk_dict'] / results['prebuilt_key'], 2)
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
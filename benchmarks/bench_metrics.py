@@ -0,0 +1,62 @@
+'''
+Benchmark of the time metrics add to each request.
+
+Runs the hooks setup_metrics registers (start timer and in-flight gauge,
+record counter and histograms, end in-flight gauge) and one add_time per
+phase inside a request context, and reports the cost per request.
+
+Usage:
+    python benchmarks/bench_metrics.py [requests]
+'''
+import os
+import sys
+import json
+import time
+
+from flask import Flask, Response
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from metrics import setup_metrics, add_time  # noqa: E402
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    app = Flask(__name__)
+    setup_metrics(app)
+
+    @app.route('/articles')
+    def get_articles():
+        return ''
+
+    before, = app.before_request_funcs[None]
+    after, = app.after_request_funcs[None]
+    teardown, = app.teardown_request_funcs[None]
+    response = Response('')
+
+    with app.test_request_context('/articles'):
+        def one_request():
+            before()
+            add_time('auth', 0.00002)
+            add_time('db', 0.002)
+            add_time('serialization', 0.0003)
+            after(response)
+            teardown(None)
+
+        for _ in range(1000):
+            one_request()
+        best = None
+        for _ in range(5):
+            start = time.perf_counter()
+            for _ in range(count):
+                one_request()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+    print(json.dumps({
+        'requests': count,
+        'overhead_us_per_request': round(best / count * 1e6, 2)
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,325 @@
+'''
+Benchmark of every route in create_app against a seeded dataset.
+
+Seeds a fresh database through synthetic.generate with about --articles
+articles by --articles / ARTICLES_PER_NUTRITIONIST nutritionists,
+CLIENTS_PER_NUTRITIONIST clients per nutritionist and about
+SUBSCRIPTIONS_PER_CLIENT subscriptions per client, which favour popular
+nutritionists (Zipf), then fans out the client feed. The same --seed
+always builds the same dataset.
+
+Requests go through the app's WSGI interface with tokens signed by a key
+made for the run; its JWKS is handed to the app through JWKS_CACHE_PATH,
+so requires_auth verifies them as it would Auth0's. Reads run first, then
+writes, each route --requests times after a warm up. Prints throughput
+and p50/p95/p99 latency per route as JSON; with --baseline, routes whose
+p95 latency or throughput got worse than --tolerance are listed under
+"regressions" and the exit status is 1.
+
+BENCH_DATABASE_URL picks the database (default a SQLite file in the temp
+directory). Its tables are dropped and recreated, so never point it at
+data you want to keep.
+
+Usage:
+    python benchmarks/bench_routes.py [--articles 1000|100000|1000000]
+        [--requests 200] [--seed 0] [--output results.json]
+        [--baseline baseline.json] [--tolerance 0.2] [--skip-seed]
+'''
+import os
+import sys
+import json
+import time
+import base64
+import random
+import argparse
+import tempfile
+import contextlib
+
+import rsa
+from jose import jwt
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TMP = tempfile.gettempdir()
+ISSUER = 'bench.local'
+AUDIENCE = 'bench'
+KID = 'bench'
+JWKS_PATH = os.path.join(TMP, 'bench_routes_jwks.json')
+
+ARTICLES_PER_NUTRITIONIST = 100
+CLIENTS_PER_NUTRITIONIST = 2
+SUBSCRIPTIONS_PER_CLIENT = 3
+PERMISSIONS = [
+    'view:nutritionist', 'create:nutritionist', 'edit:nutritionist',
+    'view:client', 'create:client', 'edit:client', 'read:article',
+    'create:article', 'edit:article', 'delete:article', 'subscribe:client',
+    'rate:nutritionist'
+]
+
+# The app reads its settings at import, so they are set before it is
+os.environ['DATABASE_URL'] = os.environ.get(
+    'BENCH_DATABASE_URL',
+    'sqlite:///' + os.path.join(TMP, 'bench_routes.db'))
+os.environ.update({
+    'AUTH0_DOMAIN': ISSUER,
+    'API_AUDIENCE': AUDIENCE,
+    'ALGORITHMS': "['RS256']",
+    'JWKS_CACHE_PATH': JWKS_PATH,
+    'JWKS_CACHE_TTL': str(10 ** 9),
+    'DB_CREATE_ALL': 'false'
+})
+sys.path.insert(0, ROOT)
+from app import create_app  # noqa: E402
+from models import (  # noqa: E402
+    db, Nutritionist, Client, Article, Subscription, ClientFeed
+)
+from synthetic import Plan, WORDS, generate  # noqa: E402
+
+
+def b64(number):
+    data = number.to_bytes((number.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def signing_key():
+    # Writes the public half where the app's JWKS cache reads it
+    public, private = rsa.newkeys(2048)
+    with open(JWKS_PATH, 'w') as f:
+        json.dump({'keys': [{'kty': 'RSA', 'kid': KID, 'use': 'sig',
+                             'alg': 'RS256', 'n': b64(public.n),
+                             'e': b64(public.e)}]}, f)
+    return private.save_pkcs1().decode()
+
+
+def sign_token(key):
+    now = int(time.time())
+    return jwt.encode({
+        'iss': 'https://{}/'.format(ISSUER), 'aud': AUDIENCE,
+        'sub': 'bench|1', 'iat': now, 'exp': now + 86400,
+        'permissions': PERMISSIONS
+    }, key, algorithm='RS256', headers={'kid': KID})
+
+
+def seed(articles, seed):
+    nutritionists = max(1, articles // ARTICLES_PER_NUTRITIONIST)
+    db.drop_all()
+    db.create_all()
+    db.session.commit()
+    generate(os.environ['DATABASE_URL'], Plan(
+        seed=seed, nutritionists=nutritionists,
+        clients=nutritionists * CLIENTS_PER_NUTRITIONIST,
+        articles_per_nutritionist=ARTICLES_PER_NUTRITIONIST,
+        subscriptions_per_client=SUBSCRIPTIONS_PER_CLIENT),
+        log=lambda line: print(line, file=sys.stderr))
+    return dataset()
+
+
+def dataset():
+    return {
+        'articles': Article.query.count(),
+        'nutritionists': Nutritionist.query.count(),
+        'clients': Client.query.count(),
+        'subscriptions': Subscription.query.count()
+    }
+
+
+def route_plans(counts, rng):
+    '''
+    Returns (route, method, request) per route, in the order they run.
+    request(i) gives the path and JSON body of the i-th request.
+    '''
+    nutritionists = counts['nutritionists']
+    clients = counts['clients']
+    unique = '{}-{}'.format(os.getpid(), int(time.time()))
+
+    def nutritionist():
+        return rng.randint(1, nutritionists)
+
+    def client():
+        return rng.randint(1, clients)
+
+    def get(path):
+        return lambda i: (path, None)
+
+    return [
+        ('/', 'GET', get('/')),
+        ('/pool', 'GET', get('/pool')),
+        ('/metrics', 'GET', get('/metrics')),
+        ('/nutritionists', 'GET', get('/nutritionists')),
+        ('/nutritionists/top', 'GET',
+         get('/nutritionists/top?by=subscribers')),
+        ('/nutritionists/<int:id>', 'GET',
+         lambda i: ('/nutritionists/{}'.format(nutritionist()), None)),
+        ('/clients', 'GET', get('/clients')),
+        ('/clients/<int:id>', 'GET',
+         lambda i: ('/clients/{}'.format(client()), None)),
+        ('/articles', 'GET', get('/articles')),
+        ('/articles?client_id', 'GET',
+         lambda i: ('/articles?client_id={}'.format(client()), None)),
+        ('/articles?nutritionist_id', 'GET',
+         lambda i: ('/articles?nutritionist_id={}'.format(nutritionist()),
+                    None)),
+        ('/articles/search', 'GET',
+         lambda i: ('/articles/search?q={}'.format(rng.choice(WORDS)), None)),
+        ('/nutritionists', 'POST', lambda i: ('/nutritionists', {
+            'name': 'New', 'specialization': 'bench',
+            'email': 'n{}-{}@bench.local'.format(unique, i)})),
+        ('/nutritionists/bulk', 'POST', lambda i: ('/nutritionists/bulk', [
+            {'name': 'New', 'specialization': 'bench',
+             'email': 'nb{}-{}-{}@bench.local'.format(unique, i, j)}
+            for j in range(100)])),
+        ('/nutritionists', 'PATCH', lambda i: ('/nutritionists', {
+            'id': nutritionist(), 'name': 'Renamed {}'.format(i)})),
+        ('/clients', 'POST', lambda i: ('/clients', {
+            'name': 'New', 'country': 'NG',
+            'email': 'c{}-{}@bench.local'.format(unique, i)})),
+        ('/clients/bulk', 'POST', lambda i: ('/clients/bulk', [
+            {'name': 'New', 'country': 'NG',
+             'email': 'cb{}-{}-{}@bench.local'.format(unique, i, j)}
+            for j in range(100)])),
+        ('/clients', 'PATCH', lambda i: ('/clients', {
+            'id': client(), 'name': 'Renamed {}'.format(i)})),
+        ('/articles', 'POST', lambda i: ('/articles', {
+            'title': 'New article', 'content': ' '.join(WORDS[:20]),
+            'nutritionist': nutritionist()})),
+        ('/articles/bulk', 'POST', lambda i: ('/articles/bulk', [
+            {'title': 'New article', 'content': ' '.join(WORDS[:20]),
+             'nutritionist': nutritionist()} for _ in range(100)])),
+        ('/articles', 'PATCH', lambda i: ('/articles', {
+            'id': rng.randint(1, counts['articles']),
+            'title': 'Edited {}'.format(i)})),
+        ('/ratings', 'POST', lambda i: ('/ratings', {
+            'client_id': client(), 'nutritionist_id': nutritionist(),
+            'score': rng.randint(1, 5)})),
+        ('/subscriptions', 'POST', lambda i: ('/subscriptions', {
+            'client_id': client(), 'nutritionist_id': nutritionist()})),
+        ('/subscriptions/bulk', 'POST', lambda i: ('/subscriptions/bulk', [
+            {'client_id': client(), 'nutritionist_id': nutritionist()}
+            for _ in range(100)])),
+        # Newest first, so no other route asks for a deleted article
+        ('/articles/<int:article_id>', 'DELETE',
+         lambda i: ('/articles/{}'.format(counts['articles'] - i), None))
+    ]
+
+
+def percentile(latencies, p):
+    return round(latencies[min(len(latencies) - 1,
+                               int(len(latencies) * p))] * 1000, 3)
+
+
+def measure(client, headers, method, request, count):
+    warm_up = max(1, count // 10)
+    latencies = []
+    statuses = {}
+    started = time.perf_counter()
+    for i in range(warm_up + count):
+        path, body = request(i)
+        start = time.perf_counter()
+        response = client.open(path, method=method, json=body,
+                               headers=headers)
+        response.get_data()
+        elapsed = time.perf_counter() - start
+        if i < warm_up:
+            started = time.perf_counter()
+            continue
+        latencies.append(elapsed)
+        status = str(response.status_code)
+        statuses[status] = statuses.get(status, 0) + 1
+    total = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'requests': count,
+        'statuses': statuses,
+        'rps': round(count / total, 1),
+        'p50_ms': percentile(latencies, 0.50),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99)
+    }
+
+
+def compare(results, baseline, tolerance):
+    # Routes whose p95 latency rose or throughput fell by more than tolerance
+    regressions = []
+    for route, result in results['routes'].items():
+        before = baseline.get('routes', {}).get(route)
+        if not before:
+            continue
+        if result['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            regressions.append({'route': route, 'metric': 'p95_ms',
+                                'baseline': before['p95_ms'],
+                                'result': result['p95_ms']})
+        if result['rps'] < before['rps'] * (1 - tolerance):
+            regressions.append({'route': route, 'metric': 'rps',
+                                'baseline': before['rps'],
+                                'result': result['rps']})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark every route against a seeded dataset.')
+    parser.add_argument('--articles', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output')
+    parser.add_argument('--baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--skip-seed', action='store_true',
+                        help='reuse the dataset of the previous run')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    headers = {'Authorization': 'Bearer ' + sign_token(signing_key())}
+    app = create_app()
+    client = app.test_client()
+
+    with app.app_context():
+        if args.skip_seed:
+            counts = dataset()
+        else:
+            started = time.perf_counter()
+            counts = seed(args.articles, args.seed)
+            counts['seed_seconds'] = round(time.perf_counter() - started, 1)
+        counts['feed_rows'] = ClientFeed.query.count()
+        db.session.remove()
+
+    plans = route_plans(counts, rng)
+    results = {
+        'database': db.engine.dialect.name,
+        'dataset': counts,
+        'seed': args.seed,
+        'routes': {}
+    }
+    # Keeps what routes print out of the JSON on stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        for route, method, request in plans:
+            results['routes']['{} {}'.format(method, route)] = measure(
+                client, headers, method, request, args.requests)
+
+    # Every route of the app must have a plan, so new ones can't be missed
+    planned = {(route.split('?')[0], method) for route, method, _ in plans}
+    results['not_benchmarked'] = sorted(
+        '{} {}'.format(method, rule.rule)
+        for rule in app.url_map.iter_rules() if rule.endpoint != 'static'
+        for method in rule.methods - {'HEAD', 'OPTIONS'}
+        if (rule.rule, method) not in planned)
+
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('dataset', {}).get('articles') != counts['articles']:
+            print('baseline was measured on a different dataset',
+                  file=sys.stderr)
+        results['regressions'] = compare(results, baseline, args.tolerance)
+        status = 1 if results['regressions'] else 0
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
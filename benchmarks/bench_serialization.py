@@ -0,0 +1,80 @@
+'''
+Benchmark for serializing an article list.
+
+Compares the old path (Article ORM objects -> format() dicts -> jsonify with
+Flask's stdlib encoder) with the fast path used by the list endpoints
+(column tuples -> serialize_rows -> serialization.dumps, which uses orjson
+when installed).
+
+Usage:
+    python benchmarks/bench_serialization.py [articles]
+'''
+import os
+import sys
+import json
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from flask import Flask, jsonify
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models import Article  # noqa: E402
+import serialization  # noqa: E402
+from serialization import dumps, serialize_rows  # noqa: E402
+
+
+def best_of(f, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best * 1000, 2)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    base = datetime(2021, 3, 31, 18, 25, 26)
+    content = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 8
+
+    articles = [Article(title='Article {}'.format(i),
+                        date_created=base + timedelta(minutes=i),
+                        content=content, nutritionist_id=1)
+                for i in range(count)]
+    Row = namedtuple('Row', 'title date_created content id')
+    rows = [Row(article.title, article.date_created, article.content, i)
+            for i, article in enumerate(articles)]
+    keys = Article.DEFAULT_FIELDS
+
+    app = Flask(__name__)
+    with app.app_context():
+        def old_path():
+            return jsonify({
+                'success': True,
+                'data': [article.format() for article in articles]
+            }).get_data()
+
+        def fast_path():
+            return dumps({
+                'success': True,
+                'data': serialize_rows(rows, keys)
+            })
+
+        # Both paths must produce the same document
+        assert json.loads(old_path()) == json.loads(fast_path())
+
+        results = {
+            'articles': count,
+            'encoder': 'orjson' if serialization.orjson else 'stdlib',
+            'jsonify_format_ms': best_of(old_path),
+            'fast_path_ms': best_of(fast_path)
+        }
+    results['speedup'] = round(
+        results['jsonify_format_ms'] / results['fast_path_ms'], 2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
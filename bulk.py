@@ -0,0 +1,107 @@
+import os
+from flask import request, abort, json, jsonify
+from models import db, bulk_insert, ResourceVersion
+
+
+BULK_MAX_ITEMS = int(os.environ.get('BULK_MAX_ITEMS', 10000))
+BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE', 1000))
+
+'''
+BULK CREATE
+Bulk endpoints take a JSON array (or {"data": [...]}) or an NDJSON body,
+validate every item up front and insert the valid ones with multi-row
+INSERTs in a single transaction.
+'''
+
+# Largest value of an INTEGER id column
+MAX_ID = 2 ** 31 - 1
+
+
+def valid_id(value):
+    # value when it is an id that can be looked up, else None
+    if type(value) is int and 0 < value <= MAX_ID:
+        return value
+    return None
+
+
+def bulk_id(value):
+    # Like valid_id, also accepting digit strings as the single item routes do
+    if isinstance(value, str) and value.isascii() and value.isdigit():
+        value = int(value)
+    return valid_id(value)
+
+
+def text_check(table, fields):
+    '''
+    A check for bulk_create rejecting items whose fields aren't strings
+    that fit their columns, before any of the batch is inserted.
+    '''
+    def check(item):
+        for field in fields:
+            if not isinstance(item[field], str):
+                return '{} must be text'.format(field)
+            length = table.c[field].type.length
+            if length and len(item[field]) > length:
+                return '{} is too long'.format(field)
+    return check
+
+
+def bulk_items():
+    try:
+        if request.mimetype == 'application/x-ndjson':
+            items = [json.loads(line) for line in
+                     request.get_data(as_text=True).splitlines()
+                     if line.strip()]
+        else:
+            items = request.get_json()
+            if isinstance(items, dict):
+                items = items.get('data')
+    except ValueError:
+        abort(422)
+    if not isinstance(items, list) or not items or len(items) > BULK_MAX_ITEMS:
+        abort(422)
+    return items
+
+
+def bulk_create(items, table, required, build_row, check=None,
+                after_insert=None):
+    '''
+    Creates a row in table for every valid item of items.
+    check(item) may return an error message to reject an item and
+    after_insert(ids) runs inside the transaction. Returns the response.
+    '''
+    results = [None] * len(items)
+    valid = []
+    for index, item in enumerate(items):
+        message = None
+        if not isinstance(item, dict) or \
+                any(not item.get(field) for field in required):
+            message = 'required fields expected'
+        elif check:
+            message = check(item)
+        if message:
+            results[index] = {'index': index, 'success': False,
+                              'message': message}
+        else:
+            valid.append(index)
+
+    if valid:
+        try:
+            ids = bulk_insert(table, [build_row(items[index])
+                                      for index in valid], BULK_CHUNK_SIZE)
+            if after_insert:
+                after_insert(ids)
+            ResourceVersion.bump(table.name)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            abort(422)
+        for index, id in zip(valid, ids):
+            results[index] = {'index': index, 'success': True, 'id': id}
+
+    return jsonify({
+        'success': True,
+        'created': len(valid),
+        'failed': len(items) - len(valid),
+        'results': results
+    })
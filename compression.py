@@ -0,0 +1,102 @@
+import os
+import zlib
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 500))
+COMPRESS_GZIP_LEVEL = int(os.environ.get('COMPRESS_GZIP_LEVEL', 6))
+COMPRESS_BROTLI_LEVEL = int(os.environ.get('COMPRESS_BROTLI_LEVEL', 4))
+COMPRESS_MIMETYPES = set(os.environ.get(
+    'COMPRESS_MIMETYPES', 'application/json,application/x-ndjson').split(','))
+
+'''
+RESPONSE COMPRESSION
+Negotiates brotli (when the brotli package is installed) or gzip from
+Accept-Encoding. Buffered responses below COMPRESS_MIN_SIZE are sent as
+they are; streamed responses are compressed chunk by chunk, each chunk
+flushed so the client gets it without waiting for the next. A 304 keeps
+the ETag variant the client sent, the one its 200 had.
+'''
+
+
+def choose_encoding():
+    # Highest q-value wins, brotli on a tie; q=0 refuses an encoding
+    return request.accept_encodings.best_match(
+        (['br'] if brotli else []) + ['gzip'])
+
+
+def compressor(encoding):
+    # (compress, flush, finish) functions of a new compressor
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=COMPRESS_BROTLI_LEVEL)
+        return compressor.process, compressor.flush, compressor.finish
+    # wbits 31 writes a gzip header and trailer
+    compressor = zlib.compressobj(COMPRESS_GZIP_LEVEL, zlib.DEFLATED, 31)
+    return (compressor.compress,
+            lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush)
+
+
+def etag_variants(etag):
+    # A compressed body is a different representation, so it gets its own
+    # strong ETag; conditional requests accept any of them
+    return [etag, etag + '-gzip', etag + '-br']
+
+
+def matching_variant(etag, if_none_match):
+    '''
+    The variant of etag in if_none_match for a 304, preferring the one of
+    the encoding this request negotiates, or None when none matches.
+    '''
+    matches = [variant for variant in etag_variants(etag)
+               if if_none_match.contains_weak(variant)]
+    if not matches:
+        return None
+    encoding = choose_encoding()
+    preferred = '{}-{}'.format(etag, encoding) if encoding else etag
+    return preferred if preferred in matches else matches[0]
+
+
+def compress_response(response):
+    # A 304 is tagged with the matching variant by conditional
+    if response.status_code < 200 or response.status_code in (204, 304) or \
+            response.mimetype not in COMPRESS_MIMETYPES or \
+            'Content-Encoding' in response.headers:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding()
+    if encoding is None:
+        return response
+
+    compress, flush, finish = compressor(encoding)
+    if response.is_streamed:
+        chunks = response.iter_encoded()
+
+        def generate():
+            for chunk in chunks:
+                data = compress(chunk) + flush()
+                if data:
+                    yield data
+            yield finish()
+
+        response.response = generate()
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        compressed = compress(data) + finish()
+        response.set_data(compressed)
+        response.headers['X-Compression-Ratio'] = '{:.2f}'.format(
+            len(data) / len(compressed))
+
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag('{}-{}'.format(etag, encoding), weak)
+    return response
@@ -0,0 +1,75 @@
+import hashlib
+from functools import wraps
+from flask import request, make_response
+from models import ResourceVersion
+from compression import matching_variant
+
+
+'''
+CONDITIONAL GET
+Routes decorated with @conditional get a strong ETag and a Last-Modified
+header derived from the version stamps of the resources they read. A
+matching If-None-Match is answered with 304 before the route's own query
+runs. If-Modified-Since is ignored: HTTP dates have one second resolution,
+so a write in the same second as the response would get a stale 304.
+'''
+
+
+def conditional(keys):
+    '''
+    keys is a list of ResourceVersion keys, or a callable receiving the
+    route's keyword arguments and returning one.
+    '''
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            resource_keys = keys(**kwargs) if callable(keys) else keys
+            etag, last_modified = validators(
+                ResourceVersion.current(resource_keys))
+
+            matched = not_modified(etag, last_modified)
+            if matched:
+                # The ETag the client holds, with its encoding suffix
+                return tag_response(make_response('', 304), matched,
+                                    last_modified)
+            response = make_response(f(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            return tag_response(response, etag, last_modified)
+
+        return wrapper
+    return conditional_decorator
+
+
+def validators(versions):
+    # (ETag, Last-Modified) for the {key: (version, updated_at)} of a route
+    updated = [updated_at for _, updated_at in versions.values()
+               if updated_at]
+    return compute_etag(versions), max(updated) if updated else None
+
+
+def tag_response(response, etag, last_modified):
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.vary.add('Accept')
+    # The ETag carries the content encoding, on a 304 too
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def compute_etag(versions):
+    # The same URL and representation at the same versions is the same body
+    digest = hashlib.sha1(request.full_path.encode('utf-8'))
+    digest.update(str(request.accept_mimetypes).encode('utf-8'))
+    for key in sorted(versions):
+        digest.update('{}={};'.format(key, versions[key][0]).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def not_modified(etag, last_modified):
+    # The matching ETag variant, or None; last_modified is informational
+    # only, see above
+    if request.if_none_match:
+        return matching_variant(etag, request.if_none_match)
+    return None
@@ -0,0 +1,194 @@
+import os
+import time
+import threading
+from flask import request, has_request_context
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool, NullPool
+
+
+'''
+DATABASE CONNECTION POOLING
+Engine options for every gunicorn worker's pool, read from the environment:
+
+    DB_POOL_SIZE            connections kept open (default 5, 0 disables pooling)
+    DB_MAX_OVERFLOW         extra connections allowed under load (default 10)
+    DB_POOL_TIMEOUT         seconds to wait for a free connection (default 30)
+    DB_POOL_RECYCLE         seconds before a connection is replaced (default 1800)
+    DB_POOL_PRE_PING        test connections before use (default true)
+    DB_STATEMENT_TIMEOUT_MS statement timeout for every query (default 0, off)
+    DB_ROUTE_TIMEOUTS       per route overrides, e.g. "get_articles=2000"
+    DB_PGBOUNCER            set timeouts per transaction so the app can sit
+                            behind PgBouncer in transaction pooling mode
+'''
+
+
+def env_flag(name, default):
+    return os.environ.get(name, str(default)).lower() in ('1', 'true', 'yes')
+
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = env_flag('DB_POOL_PRE_PING', True)
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 0))
+DB_PGBOUNCER = env_flag('DB_PGBOUNCER', False)
+DB_ROUTE_TIMEOUTS = {
+    endpoint.strip(): int(timeout)
+    for endpoint, timeout in (
+        item.split('=') for item in
+        os.environ.get('DB_ROUTE_TIMEOUTS', '').split(',') if '=' in item)
+}
+
+
+class TimedQueuePool(QueuePool):
+    # QueuePool that records how long checkouts wait for a connection
+    # Seconds covered by recent_wait()
+    RECENT_WINDOW = 1.0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.overflow_checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        # Checkouts in progress, and the longest wait of the current and
+        # the previous window
+        self.waiting = 0
+        self._window_start = 0.0
+        self._window_max = 0.0
+        self._previous_max = 0.0
+
+    def connect(self):
+        return self._timed_checkout(super().connect)
+
+    def unique_connection(self):
+        # The checkout Engine uses on SQLAlchemy 1.3
+        return self._timed_checkout(super().unique_connection)
+
+    def _timed_checkout(self, checkout):
+        start = time.perf_counter()
+        with self._stats_lock:
+            self.waiting += 1
+        try:
+            connection = checkout()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.waiting -= 1
+                self.timeouts += 1
+                self._record_wait(time.perf_counter(), self._timeout)
+            raise
+        except Exception:
+            with self._stats_lock:
+                self.waiting -= 1
+            raise
+        now = time.perf_counter()
+        waited = now - start
+        with self._stats_lock:
+            self.waiting -= 1
+            self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            self._record_wait(now, waited)
+            if self.overflow() > 0:
+                self.overflow_checkouts += 1
+        return connection
+
+    def _record_wait(self, now, waited):
+        if now - self._window_start >= self.RECENT_WINDOW:
+            # Only a window that just ended counts as the previous one
+            self._previous_max = self._window_max if \
+                now - self._window_start < 2 * self.RECENT_WINDOW else 0.0
+            self._window_start = now
+            self._window_max = 0.0
+        self._window_max = max(self._window_max, waited)
+
+    def recent_wait(self):
+        # Longest checkout wait of the last one to two windows, in seconds
+        now = time.perf_counter()
+        with self._stats_lock:
+            age = now - self._window_start
+            if age >= 2 * self.RECENT_WINDOW:
+                return 0.0
+            if age >= self.RECENT_WINDOW:
+                return self._window_max
+            return max(self._window_max, self._previous_max)
+
+
+def engine_options(uri):
+    if not uri or uri.startswith('sqlite'):
+        # SQLite (local testing) keeps SQLAlchemy's default pool
+        return {}
+
+    options = {
+        'pool_pre_ping': DB_POOL_PRE_PING,
+        'pool_recycle': DB_POOL_RECYCLE
+    }
+    if DB_POOL_SIZE > 0:
+        options.update({
+            'poolclass': TimedQueuePool,
+            'pool_size': DB_POOL_SIZE,
+            'max_overflow': DB_MAX_OVERFLOW,
+            'pool_timeout': DB_POOL_TIMEOUT
+        })
+    else:
+        options['poolclass'] = NullPool
+
+    if DB_STATEMENT_TIMEOUT_MS and not DB_PGBOUNCER \
+            and uri.startswith('postgres'):
+        # PgBouncer rejects startup options, so it gets SET LOCAL instead
+        options['connect_args'] = {
+            'options': '-c statement_timeout={}'.format(
+                DB_STATEMENT_TIMEOUT_MS)
+        }
+    return options
+
+
+@event.listens_for(Engine, 'begin')
+def set_transaction_timeout(connection):
+    if DB_PGBOUNCER and DB_STATEMENT_TIMEOUT_MS and \
+            connection.dialect.name == 'postgresql':
+        connection.execute('SET LOCAL statement_timeout = {}'.format(
+            DB_STATEMENT_TIMEOUT_MS))
+
+
+@event.listens_for(Session, 'after_begin')
+def apply_route_timeout(session, transaction, connection):
+    # The route's own timeout, on whichever connection (primary or
+    # replica) its session's transaction starts on, at its first query
+    if not DB_ROUTE_TIMEOUTS or not has_request_context():
+        return
+    timeout = DB_ROUTE_TIMEOUTS.get(request.endpoint)
+    if timeout and connection.dialect.name == 'postgresql':
+        connection.execute('SET LOCAL statement_timeout = {}'.format(
+            timeout))
+
+
+def pool_stats(engine):
+    pool = engine.pool
+    stats = {'pool': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update({
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': max(pool.overflow(), 0),
+            'max_overflow': pool._max_overflow
+        })
+    if isinstance(pool, TimedQueuePool):
+        stats.update({
+            'checkouts': pool.checkouts,
+            'overflow_checkouts': pool.overflow_checkouts,
+            'timeouts': pool.timeouts,
+            'wait_ms_total': round(pool.wait_total * 1000, 3),
+            'wait_ms_max': round(pool.wait_max * 1000, 3),
+            'wait_ms_avg': round(pool.wait_total * 1000 / pool.checkouts, 3)
+            if pool.checkouts else 0,
+            'waiting': pool.waiting,
+            'wait_ms_recent': round(pool.recent_wait() * 1000, 3)
+        })
+    return stats
@@ -0,0 +1,68 @@
+import os
+import time
+import shutil
+import tempfile
+
+
+'''
+GUNICORN SETTINGS
+With preload_app the master imports and builds the app once and workers
+fork from it, so a new worker is ready in milliseconds. Engines are
+disposed after the fork so no worker shares the master's connections.
+
+Workers write their metrics to METRICS_DIR (a fresh directory per master
+unless set) so GET /metrics reports the whole server. Callers pinned to
+the primary after a write are shared the same way through
+DB_PRIMARY_PINS_DIR.
+
+GUNICORN_THREADS above 1 runs each worker with that many threads (the
+gthread worker). Admission control then also sheds on requests in flight
+and connection pool waits; a sync worker only ever has one request.
+'''
+
+bind = '0.0.0.0:{}'.format(os.environ.get('PORT', 8000))
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 1))
+preload_app = os.environ.get(
+    'GUNICORN_PRELOAD', 'true').lower() in ('1', 'true', 'yes')
+# Set before the app, and with it metrics.py, is imported
+own_metrics_dir = 'METRICS_DIR' not in os.environ
+os.environ.setdefault('METRICS_DIR', os.path.join(
+    tempfile.gettempdir(), 'capstone-metrics-{}'.format(os.getpid())))
+own_pins_dir = 'DB_PRIMARY_PINS_DIR' not in os.environ
+os.environ.setdefault('DB_PRIMARY_PINS_DIR', os.path.join(
+    tempfile.gettempdir(), 'capstone-pins-{}'.format(os.getpid())))
+
+
+def on_starting(server):
+    from metrics import clear_dir
+    clear_dir()
+
+
+def pre_fork(server, worker):
+    worker.boot_started = time.perf_counter()
+
+
+def post_fork(server, worker):
+    if preload_app:
+        from app import get_app
+        from models import dispose_engines
+        dispose_engines(get_app())
+
+
+def post_worker_init(worker):
+    worker.log.info('worker %s booted in %.1f ms', worker.pid,
+                    (time.perf_counter() - worker.boot_started) * 1000)
+
+
+def worker_exit(server, worker):
+    # Keep the requests of the last flush interval
+    from metrics import flush
+    flush()
+
+
+def on_exit(server):
+    if own_metrics_dir:
+        shutil.rmtree(os.environ['METRICS_DIR'], ignore_errors=True)
+    if own_pins_dir:
+        shutil.rmtree(os.environ['DB_PRIMARY_PINS_DIR'], ignore_errors=True)
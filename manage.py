@@ -1,8 +1,14 @@
+import signal
+import logging
+import threading
+import multiprocessing
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
 from app import app
-from models import db
+from models import db, ClientFeed, ResourceVersion, OutboxEvent
+from synthetic import Plan, DISTRIBUTIONS, generate
+import outbox
 
 migrate = Migrate(app, db)
 manager = Manager(app)
@@ -10,5 +16,82 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+@manager.command
+def rebuild_feed():
+    '''Backfill the client feed from subscriptions and articles'''
+    ClientFeed.rebuild()
+    check_feed()
+
+
+@manager.command
+def check_feed():
+    '''Compare the client feed with subscriptions and articles'''
+    missing, stale = ClientFeed.check()
+    print('client feed: {} missing rows, {} stale rows'.format(missing, stale))
+    pending, failed = OutboxEvent.backlog()
+    if pending or failed:
+        # Missing rows may still be on their way through the outbox
+        print('outbox: {} pending events, {} failed events'.format(
+            pending, failed))
+    if missing or stale:
+        raise SystemExit(1)
+
+
+@manager.option('--seed', type=int, default=0)
+@manager.option('--nutritionists', type=int, default=1000)
+@manager.option('--clients', type=int, default=10000)
+@manager.option('--articles-per-nutritionist',
+                dest='articles_per_nutritionist', type=float, default=50)
+@manager.option('--article-distribution', dest='article_distribution',
+                choices=DISTRIBUTIONS, default='pareto')
+@manager.option('--subscriptions-per-client',
+                dest='subscriptions_per_client', type=float, default=3)
+@manager.option('--subscription-distribution',
+                dest='subscription_distribution', choices=DISTRIBUTIONS,
+                default='exponential')
+@manager.option('--popularity', type=float, default=1.0,
+                help='Zipf exponent of nutritionist popularity, 0 for uniform')
+@manager.option('--workers', type=int, default=multiprocessing.cpu_count())
+@manager.option('--skip-feed', dest='skip_feed', action='store_true')
+def generate_data(seed, nutritionists, clients, articles_per_nutritionist,
+                  article_distribution, subscriptions_per_client,
+                  subscription_distribution, popularity, workers, skip_feed):
+    '''Add deterministic synthetic nutritionists, clients, articles and
+    subscriptions'''
+    plan = Plan(seed=seed, nutritionists=nutritionists, clients=clients,
+                articles_per_nutritionist=articles_per_nutritionist,
+                article_distribution=article_distribution,
+                subscriptions_per_client=subscriptions_per_client,
+                subscription_distribution=subscription_distribution,
+                popularity=popularity, feed=not skip_feed)
+    # Workers open their own connections
+    db.engine.dispose()
+    generate(app.config['SQLALCHEMY_DATABASE_URI'], plan, workers)
+    ResourceVersion.bump('nutritionists', 'clients', 'articles',
+                         'subscriptions')
+    db.session.commit()
+
+
+@manager.option('--concurrency', type=int, default=outbox.OUTBOX_CONCURRENCY)
+@manager.option('--batch-size', dest='batch_size', type=int,
+                default=outbox.OUTBOX_BATCH_SIZE)
+@manager.option('--once', action='store_true',
+                help='Exit once no event is due')
+def outbox_worker(concurrency, batch_size, once):
+    '''Run the side effects of writes queued in the outbox'''
+    logging.basicConfig(level=logging.INFO)
+    stop = threading.Event()
+    # Finish the current batches on shutdown
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    signal.signal(signal.SIGINT, lambda *args: stop.set())
+    outbox.run(app, concurrency, batch_size, once=once, stop=stop)
+
+
+@manager.command
+def retry_outbox():
+    '''Retry outbox events that gave up'''
+    print('outbox: {} events queued again'.format(outbox.retry_failed()))
+
+
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,314 @@
+import os
+import json
+import time
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+from contextvars import ContextVar
+from flask import _request_ctx_stack
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+'''
+METRICS
+Per route request counts, latency histograms, in-flight gauges and the
+time spent in auth, the database and serialization, served by GET /metrics
+in the Prometheus text format.
+
+Each worker records into memory. With METRICS_DIR set, workers write a
+snapshot there every METRICS_FLUSH_INTERVAL seconds and /metrics
+adds up the snapshots of every worker, so any worker can be scraped.
+'''
+
+METRICS_DIR = os.environ.get('METRICS_DIR')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 1))
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+HELP = {
+    'capstone_http_requests_total':
+        ('counter', 'Requests served, by route, method and status.'),
+    'capstone_http_request_duration_seconds':
+        ('histogram', 'Time to build a response, by route and method.'),
+    'capstone_http_requests_in_flight':
+        ('gauge', 'Requests being served, by route.'),
+    'capstone_request_phase_duration_seconds':
+        ('histogram', 'Time spent per request in auth, the database and '
+                      'serialization, by route.')
+}
+
+
+class Registry:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counters = defaultdict(int)
+        self.gauges = defaultdict(int)
+        # (name, labels) -> [count per bucket..., +Inf count, sum]
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def add_gauge(self, name, labels, change):
+        with self._lock:
+            self.gauges[name, labels] += change
+
+    def observe_request(self, endpoint, method, status, seconds, phases):
+        # Everything a finished request records, under one lock
+        with self._lock:
+            self.gauges['capstone_http_requests_in_flight', (endpoint,)] -= 1
+            self.counters['capstone_http_requests_total',
+                          (endpoint, method, status)] += 1
+            self._observe('capstone_http_request_duration_seconds',
+                          (endpoint, method), seconds)
+            for phase, phase_seconds in phases.items():
+                self._observe('capstone_request_phase_duration_seconds',
+                              (endpoint, phase), phase_seconds)
+
+    def _observe(self, name, labels, value):
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[name, labels] = \
+                [0] * (len(self.buckets) + 2)
+        histogram[bisect_left(self.buckets, value)] += 1
+        histogram[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'pid': os.getpid(),
+                'counters': [[name, labels, value] for (name, labels), value
+                             in self.counters.items()],
+                'gauges': [[name, labels, value] for (name, labels), value
+                           in self.gauges.items()],
+                'histograms': [[name, labels, list(values)]
+                               for (name, labels), values
+                               in self.histograms.items()]
+            }
+
+    def clear(self):
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+
+registry = Registry()
+_flusher_pid = None
+
+LABEL_NAMES = {
+    'capstone_http_requests_total': ('endpoint', 'method', 'status'),
+    'capstone_http_request_duration_seconds': ('endpoint', 'method'),
+    'capstone_http_requests_in_flight': ('endpoint',),
+    'capstone_request_phase_duration_seconds': ('endpoint', 'phase')
+}
+
+
+class RequestTimer:
+    # What a request records, set up once so the hooks skip Flask's proxies
+    __slots__ = ('endpoint', 'method', 'started', 'phases', 'in_flight',
+                 'hooks')
+
+    def __init__(self, endpoint, method, hooks=True):
+        self.endpoint = endpoint
+        self.method = method
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.in_flight = True
+        # False when the caller, not teardown_request, ends the timer
+        self.hooks = hooks
+
+
+current_timer = ContextVar('current_timer', default=None)
+
+
+def add_time(phase, seconds):
+    # Adds to the current request's time in phase (auth, db, ...)
+    timer = current_timer.get()
+    if timer is not None:
+        timer.phases[phase] = timer.phases.get(phase, 0.0) + seconds
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context,
+                      executemany):
+    conn.info['metrics_query_started'] = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_query_timer(conn, cursor, statement, parameters, context,
+                     executemany):
+    started = conn.info.pop('metrics_query_started', None)
+    if started is not None:
+        add_time('db', time.perf_counter() - started)
+
+
+def start_timer(endpoint, method, hooks=True):
+    '''
+    Times the current request until record_request sees its response.
+    With hooks=False the timer outlives request contexts, for asgi.py,
+    which pushes several per request; the caller then calls end_timer.
+    '''
+    if METRICS_DIR and _flusher_pid != os.getpid():
+        start_flusher()
+    timer = RequestTimer(endpoint, method, hooks)
+    current_timer.set(timer)
+    registry.add_gauge('capstone_http_requests_in_flight', (endpoint,), 1)
+    return timer
+
+
+def end_timer():
+    timer = current_timer.get()
+    if timer is not None:
+        current_timer.set(None)
+        if timer.in_flight:
+            # No response was recorded for this request
+            registry.add_gauge('capstone_http_requests_in_flight',
+                               (timer.endpoint,), -1)
+
+
+def setup_metrics(app):
+    @app.before_request
+    def start_request_timer():
+        req = _request_ctx_stack.top.request
+        # Unmatched URLs share one label so clients can't grow the series
+        start_timer(req.url_rule.endpoint if req.url_rule else 'unmatched',
+                    req.method)
+
+    @app.after_request
+    def record_request(response):
+        timer = current_timer.get()
+        if timer is not None:
+            timer.in_flight = False
+            registry.observe_request(
+                timer.endpoint, timer.method, str(response.status_code),
+                time.perf_counter() - timer.started, timer.phases)
+        return response
+
+    @app.teardown_request
+    def end_request(exc):
+        timer = current_timer.get()
+        if timer is not None and timer.hooks:
+            end_timer()
+
+
+def start_flusher():
+    # One thread per worker process, started by its first request
+    global _flusher_pid
+    _flusher_pid = os.getpid()
+    threading.Thread(target=flush_forever, daemon=True).start()
+
+
+def flush_forever():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        flush()
+
+
+def flush():
+    if not METRICS_DIR:
+        return
+    path = os.path.join(METRICS_DIR, '{}.json'.format(os.getpid()))
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(registry.snapshot(), f)
+        # Atomic so a scrape never reads a half written file
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+
+def snapshots():
+    # This worker's live registry and the last flush of every other one
+    found = [registry.snapshot()]
+    if not METRICS_DIR:
+        return found
+    own = '{}.json'.format(os.getpid())
+    for name in os.listdir(METRICS_DIR):
+        if not name.endswith('.json') or name == own:
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, name)) as f:
+                found.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return found
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def collect():
+    '''
+    Adds up every worker's snapshot. Counters and histograms keep the
+    totals of workers that exited; gauges only count live workers.
+    '''
+    counters = defaultdict(int)
+    gauges = defaultdict(int)
+    histograms = {}
+    for snapshot in snapshots():
+        for name, labels, value in snapshot['counters']:
+            counters[name, tuple(labels)] += value
+        if alive(snapshot['pid']):
+            for name, labels, value in snapshot['gauges']:
+                gauges[name, tuple(labels)] += value
+        for name, labels, values in snapshot['histograms']:
+            total = histograms.setdefault(
+                (name, tuple(labels)), [0] * len(values))
+            for i, value in enumerate(values):
+                total[i] += value
+    return counters, gauges, histograms
+
+
+def format_labels(name, labels, extra=()):
+    pairs = list(zip(LABEL_NAMES[name], labels)) + list(extra)
+    return '{' + ','.join('{}="{}"'.format(
+        key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for key, value in pairs) + '}'
+
+
+def render():
+    # Prometheus text exposition format 0.0.4
+    counters, gauges, histograms = collect()
+    lines = []
+    for name, (kind, text) in HELP.items():
+        lines.append('# HELP {} {}'.format(name, text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        if kind == 'counter' or kind == 'gauge':
+            series = counters if kind == 'counter' else gauges
+            for (series_name, labels), value in sorted(series.items()):
+                if series_name == name:
+                    lines.append('{}{} {}'.format(
+                        name, format_labels(name, labels), repr(value)))
+            continue
+        for (series_name, labels), values in sorted(histograms.items()):
+            if series_name != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), values[:-1]):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    name, format_labels(name, labels, [('le', bound)]),
+                    cumulative))
+            lines.append('{}_sum{} {}'.format(
+                name, format_labels(name, labels), repr(values[-1])))
+            lines.append('{}_count{} {}'.format(
+                name, format_labels(name, labels), cumulative))
+    return '\n'.join(lines) + '\n'
+
+
+def clear_dir():
+    # gunicorn on_starting: counters start from zero with a new master
+    if not METRICS_DIR:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    for name in os.listdir(METRICS_DIR):
+        if name.endswith('.json') or name.endswith('.tmp'):
+            os.remove(os.path.join(METRICS_DIR, name))
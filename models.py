@@ -1,36 +1,125 @@
 import os
-from sqlalchemy import Column, String, Integer, DateTime
-from flask_sqlalchemy import SQLAlchemy
+import sys
+import threading
+from sqlalchemy import Column, String, Integer, DateTime, DDL, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects import postgresql
 import json
-from flask_migrate import Migrate
-from sqlalchemy.sql import func
+from datetime import datetime, timezone
+from database import engine_options, env_flag
+from replicas import RoutingSQLAlchemy, setup_replicas
+from sqlalchemy.sql import func, select, and_, true, tuple_, case, cast
+from sqlalchemy import inspect
 
 database_name = "capstone"
 # database_path = "postgresql://{}/{}".format(
 #     'postgres:root@localhost:5432', database_name)
 database_path = os.environ.get('DATABASE_URL')
+# The schema belongs to the migrations; create_all only for throwaway DBs
+DB_CREATE_ALL = env_flag('DB_CREATE_ALL', False)
+# Rows each resource version is spread over; only ever raise it
+RESOURCE_VERSION_SLOTS = int(os.environ.get('RESOURCE_VERSION_SLOTS', 8))
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 def setup_db(app):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
     db.app = app
     db.init_app(app)
-    migrate = Migrate(app, db)
-    db.create_all()
+    if 'flask_migrate' in sys.modules:
+        # Only the migration commands need Flask-Migrate, and importing
+        # alembic is a good part of a worker's boot time
+        from flask_migrate import Migrate
+        migrate = Migrate(app, db)
+    setup_replicas(app)
+    if DB_CREATE_ALL:
+        db.create_all()
+
+
+def dispose_engines(app):
+    # A forked worker must not reuse connections opened by its parent
+    with app.app_context():
+        db.engine.dispose()
+    app.extensions['db_replicas'].dispose()
+
+
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    # SQLite (local testing) only enforces foreign keys when asked to
+    if type(dbapi_connection).__module__ == 'sqlite3':
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+
+def insert_ignore_statement(table):
+    # INSERT that skips rows violating a unique constraint
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    elif dialect == 'sqlite':
+        return table.insert().prefix_with('OR IGNORE')
+    return table.insert().prefix_with('IGNORE')
+
+
+def insert_ignore(table, rows):
+    '''
+    INSERT rows into table in one statement, skipping rows that would violate
+    a unique constraint. Returns the number of rows inserted.
+    '''
+    if isinstance(rows, dict):
+        rows = [rows]
+    return db.session.execute(
+        insert_ignore_statement(table).values(rows)).rowcount
+
+
+def bulk_insert(table, rows, chunk_size=1000):
+    '''
+    INSERT rows into table in the session's transaction and return their ids
+    in order. PostgreSQL gets one multi-row INSERT ... RETURNING per chunk.
+    '''
+    ids = []
+    if db.session.get_bind().dialect.name == 'postgresql':
+        for start in range(0, len(rows), chunk_size):
+            result = db.session.execute(table.insert().values(
+                rows[start:start + chunk_size]).returning(table.c.id))
+            ids.extend(row[0] for row in result)
+    else:
+        for row in rows:
+            result = db.session.execute(table.insert(), row)
+            ids.append(result.inserted_primary_key[0])
+    return ids
 
 '''
     NUTRITIONIST MODEL
 '''
 class Nutritionist(db.Model):
     __tablename__ = 'nutritionists'
+    __table_args__ = (
+        # The leaderboards walk these from the top, so they take the same
+        # time however many nutritionists there are
+        db.Index('ix_nutritionists_rating_average', 'rating_average', 'id'),
+        db.Index('ix_nutritionists_subscriber_count',
+                 'subscriber_count', 'id'),
+    )
+    # Fields a client may ask for with ?fields=
+    FIELDS = ('id', 'name', 'specialization', 'rating', 'email',
+              'rating_average', 'rating_count')
 
     id = db.Column(Integer, primary_key=True)
     name = db.Column(String(200), nullable=False)
     specialization = db.Column(String(100), nullable=False)
+    # Average client rating rounded to a whole number
     rating = db.Column(Integer, default=0)
-    email = db.Column(String(100), nullable=False)
+    email = db.Column(String(100), nullable=False, index=True)
+    # Aggregates of the ratings table, kept in step by Rating.rate
+    rating_sum = db.Column(db.BigInteger, nullable=False, default=0)
+    rating_count = db.Column(Integer, nullable=False, default=0)
+    rating_average = db.Column(db.Float, nullable=False, default=0)
+    # Active subscriptions, kept in step by Subscription
+    subscriber_count = db.Column(Integer, nullable=False, default=0)
     subscriptions = db.relationship(
         'Subscription', backref='subscription_nutritionist', lazy=True)
     articles = db.relationship(
@@ -44,12 +133,48 @@ class Nutritionist(db.Model):
 
     def insert(self):
         db.session.add(self)
+        ResourceVersion.bump('nutritionists')
         db.session.commit()
 
     def update(self):
+        ResourceVersion.bump('nutritionists', 'nutritionists:{}'.format(self.id))
         db.session.commit()
 
-    def format(self):
+    @classmethod
+    def add_rating(cls, id, score_delta, count_delta):
+        # One relative UPDATE, so concurrent ratings never lose each other
+        total = cls.rating_sum + score_delta
+        count = cls.rating_count + count_delta
+        average = cast(total, db.Float) / count
+        cls.query.filter(cls.id == id).update({
+            cls.rating_sum: total,
+            cls.rating_count: count,
+            cls.rating_average: average,
+            cls.rating: cast(func.round(average), Integer)
+        }, synchronize_session=False)
+
+    @classmethod
+    def add_subscribers(cls, counts):
+        # counts is {nutritionist_id: change}, applied in one UPDATE
+        if not counts:
+            return
+        cls.query.filter(cls.id.in_(counts)).update({
+            cls.subscriber_count: cls.subscriber_count + case(
+                counts, value=cls.id, else_=0)
+        }, synchronize_session=False)
+
+    @classmethod
+    def count_subscribers(cls, ids):
+        # Recounts from the subscriptions table
+        active = select([func.count(Subscription.id)]).where(and_(
+            Subscription.nutritionist_id == cls.id,
+            Subscription.subscription_status == true())).as_scalar()
+        cls.query.filter(cls.id.in_(ids)).update(
+            {cls.subscriber_count: active}, synchronize_session=False)
+
+    def format(self, fields=None):
+        if fields:
+            return {field: getattr(self, field) for field in fields}
         return {
             'id': self.id,
             'name': self.name,
@@ -64,11 +189,12 @@ class Nutritionist(db.Model):
 '''
 class Client(db.Model):
     __tablename__ = 'clients'
+    FIELDS = ('id', 'name', 'country', 'email')
 
     id = db.Column(Integer, primary_key=True)
     name = db.Column(String(200), nullable=False)
     country = db.Column(String(100), nullable=False)
-    email = db.Column(String(100), nullable=False)
+    email = db.Column(String(100), nullable=False, index=True)
     subscriptions = db.relationship(
         'Subscription', backref='client_nutritionist', lazy=True)
 
@@ -79,16 +205,21 @@ class Client(db.Model):
 
     def insert(self):
         db.session.add(self)
+        ResourceVersion.bump('clients')
         db.session.commit()
 
     def update(self):
+        ResourceVersion.bump('clients', 'clients:{}'.format(self.id))
         db.session.commit()
 
     def delete(self):
+        ResourceVersion.bump('clients', 'clients:{}'.format(self.id))
         db.session.delete(self)
         db.session.commit()
 
-    def format(self):
+    def format(self, fields=None):
+        if fields:
+            return {field: getattr(self, field) for field in fields}
         return {
             'name': self.name,
             'country': self.country,
@@ -103,6 +234,16 @@ class Client(db.Model):
 
 class Article(db.Model):
     __tablename__ = 'articles'
+    __table_args__ = (
+        # Keyset pagination walks this index newest first
+        db.Index('ix_articles_date_created_id', 'date_created', 'id'),
+        # Articles by author, newest first
+        db.Index('ix_articles_nutritionist_date',
+                 'nutritionist_id', 'date_created', 'id'),
+    )
+    FIELDS = ('id', 'title', 'date_created', 'content', 'nutritionist_id')
+    # Fields format() returns when none are requested
+    DEFAULT_FIELDS = ('title', 'date_created', 'content')
 
     id = db.Column(Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
@@ -120,16 +261,30 @@ class Article(db.Model):
 
     def insert(self):
         db.session.add(self)
+        db.session.flush()
+        OutboxEvent.publish('articles.created', ids=[self.id])
+        ResourceVersion.bump('articles')
         db.session.commit()
 
     def update(self):
+        # date_created and the author may have changed, so re-fan-out
+        db.session.flush()
+        ClientFeed.query.filter(ClientFeed.article_id == self.id).delete(
+            synchronize_session=False)
+        ClientFeed.fan_out(Article.id == self.id)
+        ResourceVersion.bump('articles')
         db.session.commit()
 
     def delete(self):
+        ClientFeed.query.filter(ClientFeed.article_id == self.id).delete(
+            synchronize_session=False)
+        ResourceVersion.bump('articles')
         db.session.delete(self)
         db.session.commit()
 
-    def format(self):
+    def format(self, fields=None):
+        if fields:
+            return {field: getattr(self, field) for field in fields}
         return {
             'title': self.title,
             'date_created': self.date_created,
@@ -137,14 +292,78 @@ class Article(db.Model):
         }
 
 
+'''
+ARTICLE SEARCH INDEX
+PostgreSQL keeps a weighted tsvector of each article (title A, content B)
+in articles.search_vector, set by a trigger and searched through a GIN
+index. SQLite keeps the FTS5 table articles_fts in step with triggers.
+The migration creates the PostgreSQL side for existing databases.
+'''
+ARTICLE_SEARCH_DDL = {
+    'postgresql': [
+        'ALTER TABLE articles ADD COLUMN search_vector tsvector',
+        'CREATE INDEX ix_articles_search ON articles '
+        'USING gin (search_vector)',
+        '''CREATE FUNCTION articles_search_vector_update() RETURNS trigger AS $$
+        BEGIN
+            NEW.search_vector :=
+                setweight(to_tsvector('english', coalesce(NEW.title, '')), 'A') ||
+                setweight(to_tsvector('english', coalesce(NEW.content, '')), 'B');
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql''',
+        'CREATE TRIGGER articles_search_vector '
+        'BEFORE INSERT OR UPDATE OF title, content ON articles '
+        'FOR EACH ROW EXECUTE PROCEDURE articles_search_vector_update()'
+    ],
+    'sqlite': [
+        "CREATE VIRTUAL TABLE articles_fts USING fts5("
+        "title, content, content='articles', content_rowid='id')",
+        '''CREATE TRIGGER articles_fts_insert AFTER INSERT ON articles BEGIN
+            INSERT INTO articles_fts (rowid, title, content)
+            VALUES (new.id, new.title, new.content);
+        END''',
+        '''CREATE TRIGGER articles_fts_delete AFTER DELETE ON articles BEGIN
+            INSERT INTO articles_fts (articles_fts, rowid, title, content)
+            VALUES ('delete', old.id, old.title, old.content);
+        END''',
+        '''CREATE TRIGGER articles_fts_update
+        AFTER UPDATE OF title, content ON articles BEGIN
+            INSERT INTO articles_fts (articles_fts, rowid, title, content)
+            VALUES ('delete', old.id, old.title, old.content);
+            INSERT INTO articles_fts (rowid, title, content)
+            VALUES (new.id, new.title, new.content);
+        END'''
+    ]
+}
+
+# What dropping the articles table leaves behind
+ARTICLE_SEARCH_DROP_DDL = {
+    'postgresql': ['DROP FUNCTION IF EXISTS articles_search_vector_update()'],
+    'sqlite': ['DROP TABLE IF EXISTS articles_fts']
+}
+
+for hook, ddl in (('after_create', ARTICLE_SEARCH_DDL),
+                  ('after_drop', ARTICLE_SEARCH_DROP_DDL)):
+    for dialect, statements in ddl.items():
+        for statement in statements:
+            event.listen(Article.__table__, hook,
+                         DDL(statement).execute_if(dialect=dialect))
+
+
 '''
     SUBSCRIPTION MODEL
 '''
 class Subscription(db.Model):
     __tablename__ = 'subscriptions'
+    __table_args__ = (
+        # A client subscribes to a nutritionist at most once
+        db.Index('uq_subscriptions_client_nutritionist',
+                 'client_id', 'nutritionist_id', unique=True),
+    )
 
     id = db.Column(Integer, primary_key=True)
-    nutritionist_id = db.Column(Integer, db.ForeignKey('nutritionists.id'), nullable=False)
+    nutritionist_id = db.Column(Integer, db.ForeignKey('nutritionists.id'), nullable=False, index=True)
     client_id = db.Column(Integer, db.ForeignKey('clients.id'), nullable=False)
     subscription_status = db.Column(db.Boolean, nullable=False, default=True)
     
@@ -155,19 +374,337 @@ class Subscription(db.Model):
         
     def insert(self):
         db.session.add(self)
+        db.session.flush()
+        OutboxEvent.publish('subscriptions.created',
+                            pairs=[[self.client_id, self.nutritionist_id]])
+        if self.subscription_status:
+            Nutritionist.add_subscribers({self.nutritionist_id: 1})
+        ResourceVersion.bump('subscriptions')
         db.session.commit()
         
     def update(self):
+        # The subscription may have been paused or resumed
+        counts = self._subscriber_changes()
+        db.session.flush()
+        self._clear_feed()
+        ClientFeed.fan_out(Subscription.id == self.id)
+        if counts is None:
+            Nutritionist.count_subscribers([self.nutritionist_id])
+        else:
+            Nutritionist.add_subscribers(counts)
+        ResourceVersion.bump('subscriptions')
         db.session.commit()
 
     def delete(self):
+        self._clear_feed()
+        if self.subscription_status:
+            Nutritionist.add_subscribers({self.nutritionist_id: -1})
+        ResourceVersion.bump('subscriptions')
         db.session.delete(self)
         db.session.commit()
 
+    @classmethod
+    def subscribe(cls, nutritionist_id, client_id, subscription_status=True):
+        '''
+        Inserts the subscription unless it already exists, relying on the
+        unique index instead of reading first. Returns False for a duplicate;
+        unknown ids raise IntegrityError from the foreign keys.
+        '''
+        created = insert_ignore(cls.__table__, {
+            'nutritionist_id': nutritionist_id,
+            'client_id': client_id,
+            'subscription_status': subscription_status
+        })
+        if created:
+            OutboxEvent.publish('subscriptions.created',
+                                pairs=[[client_id, nutritionist_id]])
+            if subscription_status:
+                Nutritionist.add_subscribers({nutritionist_id: 1})
+            ResourceVersion.bump('subscriptions')
+        db.session.commit()
+        return bool(created)
+
+    @classmethod
+    def subscribe_many(cls, pairs, chunk_size=1000):
+        '''
+        Subscribes every (client_id, nutritionist_id) pair that doesn't exist
+        yet. pairs must reference existing rows. Returns the created count.
+        '''
+        created = 0
+        for start in range(0, len(pairs), chunk_size):
+            chunk = pairs[start:start + chunk_size]
+            pair_key = tuple_(cls.client_id, cls.nutritionist_id)
+            # Anti-join: one query finds the pairs that already exist
+            existing = set(db.session.query(
+                cls.client_id, cls.nutritionist_id).filter(
+                    pair_key.in_(chunk)))
+            new_pairs = [pair for pair in chunk if pair not in existing]
+            if not new_pairs:
+                continue
+            inserted = insert_ignore(cls.__table__, [{
+                'client_id': client_id,
+                'nutritionist_id': nutritionist_id,
+                'subscription_status': True
+            } for client_id, nutritionist_id in new_pairs])
+            OutboxEvent.publish('subscriptions.created',
+                                pairs=[list(pair) for pair in new_pairs])
+            if inserted == len(new_pairs):
+                counts = {}
+                for _, nutritionist_id in new_pairs:
+                    counts[nutritionist_id] = counts.get(nutritionist_id, 0) + 1
+                Nutritionist.add_subscribers(counts)
+            else:
+                # A concurrent request added some of them first
+                Nutritionist.count_subscribers(
+                    {nutritionist_id for _, nutritionist_id in new_pairs})
+            created += inserted
+        if created:
+            ResourceVersion.bump('subscriptions')
+        db.session.commit()
+        return created
+
+    def _subscriber_changes(self):
+        '''
+        {nutritionist_id: change} to subscriber counts for the pending status
+        or author change, or None when the previous values weren't loaded.
+        '''
+        state = inspect(self).attrs
+        nutritionist_ids = state.nutritionist_id.history.non_added()
+        statuses = state.subscription_status.history.non_added()
+        if not nutritionist_ids or not statuses:
+            return None
+        counts = {nutritionist_ids[0]: -1 if statuses[0] else 0}
+        if self.subscription_status:
+            counts[self.nutritionist_id] = counts.get(
+                self.nutritionist_id, 0) + 1
+        return {id: change for id, change in counts.items() if change}
+
+    def _clear_feed(self):
+        articles = select([Article.id]).where(
+            Article.nutritionist_id == self.nutritionist_id)
+        ClientFeed.query.filter(
+            ClientFeed.client_id == self.client_id,
+            ClientFeed.article_id.in_(articles)
+        ).delete(synchronize_session=False)
+
     def format(self):
         return {
             'nutritionist_id': self.nutritionist_id,
             'client_id': self.client_id,
             'subscription_status': self.subscription_status
         }
+
+
+'''
+    RATING MODEL
+    One score per client and nutritionist; a new score replaces the old one
+'''
+class Rating(db.Model):
+    __tablename__ = 'ratings'
+    __table_args__ = (
+        db.Index('uq_ratings_client_nutritionist',
+                 'client_id', 'nutritionist_id', unique=True),
+    )
+    MIN_SCORE = 1
+    MAX_SCORE = 5
+
+    id = db.Column(Integer, primary_key=True)
+    nutritionist_id = db.Column(Integer, db.ForeignKey(
+        'nutritionists.id', ondelete='CASCADE'), nullable=False, index=True)
+    client_id = db.Column(Integer, db.ForeignKey(
+        'clients.id', ondelete='CASCADE'), nullable=False)
+    score = db.Column(Integer, nullable=False)
+    updated_at = db.Column(DateTime(timezone=True), nullable=False)
+
+    @classmethod
+    def rate(cls, nutritionist_id, client_id, score):
+        '''
+        Stores the client's score and updates the nutritionist's aggregates
+        in the same transaction. Returns True for a first rating, False when
+        it replaced an earlier one; unknown ids raise IntegrityError.
+        '''
+        now = datetime.now(timezone.utc)
+        created = insert_ignore(cls.__table__, {
+            'nutritionist_id': nutritionist_id,
+            'client_id': client_id,
+            'score': score,
+            'updated_at': now
+        })
+        if created:
+            Nutritionist.add_rating(nutritionist_id, score, 1)
+        else:
+            # Lock the client's rating so a concurrent re-rate can't apply
+            # the same old score twice
+            rating = cls.query.filter(
+                cls.client_id == client_id,
+                cls.nutritionist_id == nutritionist_id
+            ).with_for_update().one()
+            Nutritionist.add_rating(nutritionist_id, score - rating.score, 0)
+            rating.score = score
+            rating.updated_at = now
+        ResourceVersion.bump('nutritionists',
+                             'nutritionists:{}'.format(nutritionist_id))
+        db.session.commit()
+        return bool(created)
+
+
+'''
+    CLIENT FEED MODEL
+    Articles each client is subscribed to, written by the outbox worker
+    after an article or a subscription is created so reading a feed is a
+    single index range scan
+'''
+class ClientFeed(db.Model):
+    __tablename__ = 'client_feed'
+    __table_args__ = (
+        # Covers the feed read: client_id, newest first, keyset on article_id
+        db.Index('ix_client_feed_client_date_article',
+                 'client_id', 'date_created', 'article_id'),
+    )
+
+    client_id = db.Column(Integer, db.ForeignKey(
+        'clients.id', ondelete='CASCADE'), primary_key=True)
+    article_id = db.Column(Integer, db.ForeignKey(
+        'articles.id', ondelete='CASCADE'), primary_key=True)
+    date_created = db.Column(DateTime(timezone=True))
+
+    # Rows a feed should contain: active subscriptions x their authors' articles
+    @staticmethod
+    def expected(*criteria):
+        return select([
+            Subscription.client_id, Article.id, Article.date_created
+        ]).where(and_(
+            Article.nutritionist_id == Subscription.nutritionist_id,
+            Subscription.subscription_status == true(),
+            *criteria
+        ))
+
+    # INSERT ... SELECT the feed rows matching criteria, in the session's
+    # transaction. Rows already in the feed are skipped.
+    @classmethod
+    def fan_out(cls, *criteria):
+        db.session.execute(insert_ignore_statement(cls.__table__).from_select(
+            ['client_id', 'article_id', 'date_created'],
+            cls.expected(*criteria)))
+
+    @classmethod
+    def rebuild(cls):
+        cls.query.delete(synchronize_session=False)
+        cls.fan_out()
+        ResourceVersion.bump('subscriptions')
+        db.session.commit()
+
+    # Returns (missing, stale) row counts between the feed and its sources
+    @classmethod
+    def check(cls):
+        actual = select([cls.client_id, cls.article_id, cls.date_created])
+        expected = cls.expected()
+        missing = db.session.execute(select([func.count()]).select_from(
+            expected.except_(actual).alias())).scalar()
+        stale = db.session.execute(select([func.count()]).select_from(
+            actual.except_(expected).alias())).scalar()
+        return missing, stale
     
+
+
+'''
+    RESOURCE VERSION MODEL
+    Version stamp per collection ("articles") and per resource
+    ("nutritionists:1"), bumped in the same transaction as every write so
+    GET routes can answer conditional requests without running their query.
+    A key is spread over RESOURCE_VERSION_SLOTS rows ("articles",
+    "articles#1", ...) and its version is their sum: each thread bumps its
+    own slot, so concurrent writers to a collection rarely wait for each
+    other's row lock until they commit
+'''
+class ResourceVersion(db.Model):
+    __tablename__ = 'resource_versions'
+
+    key = db.Column(String(100), primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+    updated_at = db.Column(DateTime(timezone=True), nullable=False)
+
+    @staticmethod
+    def slot_key(key, slot):
+        return key if slot == 0 else '{}#{}'.format(key, slot)
+
+    @classmethod
+    def bump(cls, *keys):
+        now = datetime.now(timezone.utc)
+        # Fixed per thread, so a transaction bumping a key twice takes one
+        # lock, and in key order, so two transactions can't deadlock
+        slot = hash((os.getpid(), threading.get_ident())) % \
+            RESOURCE_VERSION_SLOTS
+        for key in sorted(set(keys)):
+            key = cls.slot_key(key, slot)
+            bumped = cls.query.filter(cls.key == key).update(
+                {cls.version: cls.version + 1, cls.updated_at: now},
+                synchronize_session=False)
+            if not bumped and not insert_ignore(cls.__table__, {
+                    'key': key, 'version': 1, 'updated_at': now}):
+                # Another transaction created the row first
+                cls.query.filter(cls.key == key).update(
+                    {cls.version: cls.version + 1, cls.updated_at: now},
+                    synchronize_session=False)
+
+    # {slot key: key} of every slot of keys
+    @classmethod
+    def slot_keys(cls, keys):
+        return {cls.slot_key(key, slot): key for key in keys
+                for slot in range(RESOURCE_VERSION_SLOTS)}
+
+    # Sums (slot key, version, updated_at) rows into
+    # {key: (version, updated_at)}, missing keys are (0, None)
+    @classmethod
+    def combine(cls, keys, rows):
+        slots = cls.slot_keys(keys)
+        versions = {key: (0, None) for key in keys}
+        for slot_key, version, updated_at in rows:
+            key = slots[slot_key]
+            total, latest = versions[key]
+            versions[key] = (total + version, max(latest, updated_at)
+                             if latest else updated_at)
+        return versions
+
+    @classmethod
+    def current(cls, keys):
+        return cls.combine(keys, cls.query.with_entities(
+            cls.key, cls.version, cls.updated_at).filter(
+                cls.key.in_(cls.slot_keys(keys))))
+
+
+'''
+    OUTBOX EVENT MODEL
+    Side effects of a write, queued in the write's own transaction and run
+    later by the outbox worker (outbox.py). available_at is when the next
+    attempt is due, NULL once the event gave up after too many attempts
+'''
+class OutboxEvent(db.Model):
+    __tablename__ = 'outbox_events'
+    __table_args__ = (
+        # The worker claims due events oldest first through this index
+        db.Index('ix_outbox_events_available_at', 'available_at', 'id'),
+    )
+
+    id = db.Column(db.BigInteger().with_variant(Integer, 'sqlite'),
+                   primary_key=True)
+    topic = db.Column(String(100), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    attempts = db.Column(Integer, nullable=False, default=0)
+    available_at = db.Column(DateTime(timezone=True))
+    last_error = db.Column(db.Text)
+    created_at = db.Column(DateTime(timezone=True), nullable=False)
+
+    @classmethod
+    def publish(cls, topic, **payload):
+        # Adds the event to the session; it commits with the write
+        now = datetime.now(timezone.utc)
+        db.session.add(cls(topic=topic, payload=json.dumps(payload),
+                           attempts=0, available_at=now, created_at=now))
+
+    # Returns (pending, failed) event counts
+    @classmethod
+    def backlog(cls):
+        pending = cls.query.filter(cls.available_at.isnot(None)).count()
+        failed = cls.query.filter(cls.available_at.is_(None)).count()
+        return pending, failed
@@ -0,0 +1,159 @@
+import os
+import json
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from sqlalchemy.sql import tuple_
+from models import db, Article, Subscription, ClientFeed, ResourceVersion, \
+    OutboxEvent
+
+
+'''
+TRANSACTIONAL OUTBOX
+Writes queue their side effects as outbox_events rows in their own
+transaction (OutboxEvent.publish), so the request only pays for one INSERT
+and an event exists exactly when its write committed. The worker started
+with `python manage.py outbox_worker` claims due events in batches with
+SELECT ... FOR UPDATE SKIP LOCKED, so any number of worker threads and
+processes share the queue without handling an event twice, and runs each
+in a savepoint. A failed event is retried with exponential backoff until
+OUTBOX_MAX_ATTEMPTS, then kept with available_at NULL for inspection.
+
+Handlers must be idempotent: an event runs again when its batch fails to
+commit. They return the ResourceVersion keys to bump, once per batch.
+
+    OUTBOX_BATCH_SIZE     events claimed per transaction (default 100)
+    OUTBOX_CONCURRENCY    worker threads (default 2)
+    OUTBOX_POLL_INTERVAL  seconds to sleep once the queue is empty (default 1)
+    OUTBOX_MAX_ATTEMPTS   attempts before an event gives up (default 10)
+    OUTBOX_RETRY_BACKOFF  seconds before the first retry, doubled after
+                          each failure (default 1)
+'''
+
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', 100))
+OUTBOX_CONCURRENCY = int(os.environ.get('OUTBOX_CONCURRENCY', 2))
+OUTBOX_POLL_INTERVAL = float(os.environ.get('OUTBOX_POLL_INTERVAL', 1))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 10))
+OUTBOX_RETRY_BACKOFF = float(os.environ.get('OUTBOX_RETRY_BACKOFF', 1))
+
+logger = logging.getLogger(__name__)
+
+HANDLERS = {}
+
+
+def handler(topic):
+    def register(f):
+        HANDLERS[topic] = f
+        return f
+    return register
+
+
+@handler('articles.created')
+def fan_out_articles(payload):
+    # New articles reach their author's subscribers
+    ClientFeed.fan_out(Article.id.in_(payload['ids']))
+    return ['articles']
+
+
+@handler('subscriptions.created')
+def fan_out_subscriptions(payload):
+    # A new subscriber gets the author's existing articles
+    ClientFeed.fan_out(tuple_(
+        Subscription.client_id, Subscription.nutritionist_id
+    ).in_([tuple(pair) for pair in payload['pairs']]))
+    return ['subscriptions']
+
+
+def retry_delay(attempts):
+    return timedelta(seconds=OUTBOX_RETRY_BACKOFF * 2 ** (attempts - 1))
+
+
+def drain(batch_size=OUTBOX_BATCH_SIZE):
+    '''
+    Claims up to batch_size due events and runs them in one transaction.
+    Handled events are deleted, failed ones rescheduled. Returns the
+    number of events claimed.
+    '''
+    now = datetime.now(timezone.utc)
+    events = OutboxEvent.query.filter(
+        OutboxEvent.available_at <= now
+    ).order_by(
+        OutboxEvent.available_at, OutboxEvent.id
+    ).limit(batch_size).with_for_update(skip_locked=True).all()
+
+    keys = set()
+    for event in events:
+        try:
+            with db.session.begin_nested():
+                keys.update(HANDLERS[event.topic](json.loads(event.payload)))
+        except Exception as e:
+            event.attempts += 1
+            event.last_error = '{}: {}'.format(type(e).__name__, e)
+            if event.attempts >= OUTBOX_MAX_ATTEMPTS:
+                event.available_at = None
+                logger.error('outbox event %s (%s) gave up after %s '
+                             'attempts: %s', event.id, event.topic,
+                             event.attempts, event.last_error)
+            else:
+                event.available_at = now + retry_delay(event.attempts)
+                logger.warning('outbox event %s (%s) failed, attempt %s: %s',
+                               event.id, event.topic, event.attempts,
+                               event.last_error)
+        else:
+            db.session.delete(event)
+    if keys:
+        ResourceVersion.bump(*sorted(keys))
+    db.session.commit()
+    return len(events)
+
+
+def retry_failed():
+    # Gives events that gave up a new round of attempts
+    count = OutboxEvent.query.filter(OutboxEvent.available_at.is_(None)).update(
+        {OutboxEvent.attempts: 0,
+         OutboxEvent.available_at: datetime.now(timezone.utc)},
+        synchronize_session=False)
+    db.session.commit()
+    return count
+
+
+def work(app, batch_size, poll_interval, once, stop):
+    # One worker thread, with its own app context and session
+    with app.app_context():
+        try:
+            while not stop.is_set():
+                try:
+                    claimed = drain(batch_size)
+                except Exception:
+                    db.session.rollback()
+                    logger.exception('outbox batch failed')
+                    claimed = 0
+                if claimed < batch_size:
+                    if once:
+                        break
+                    stop.wait(poll_interval)
+        finally:
+            db.session.remove()
+
+
+def run(app, concurrency=OUTBOX_CONCURRENCY, batch_size=OUTBOX_BATCH_SIZE,
+        poll_interval=OUTBOX_POLL_INTERVAL, once=False, stop=None):
+    '''
+    Drains the outbox with concurrency threads until stop is set, or with
+    once until no event is due. SQLite always uses one thread.
+    '''
+    stop = stop or threading.Event()
+    with app.app_context():
+        if db.engine.dialect.name == 'sqlite':
+            # No row locks to share the queue with, and one writer at a time
+            concurrency = 1
+    threads = [threading.Thread(
+        target=work, args=(app, batch_size, poll_interval, once, stop),
+        name='outbox-{}'.format(number), daemon=True)
+        for number in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        # A timeout keeps the main thread responsive to signals
+        while thread.is_alive():
+            thread.join(0.5)
@@ -0,0 +1,93 @@
+import os
+import json
+import math
+import base64
+from datetime import datetime
+from flask import request, abort
+from sqlalchemy import literal, tuple_
+
+
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', 50))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 200))
+
+'''
+KEYSET PAGINATION
+List endpoints take ?limit= and an opaque ?cursor= and return next_cursor.
+The cursor holds the sort key of the last row served, so every page is an
+index range scan no matter how deep it is.
+'''
+
+
+def page_args(columns):
+    # Read limit and the decoded cursor for columns from the query string
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE)
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        abort(422)
+    if limit < 1:
+        abort(422)
+    cursor = request.args.get('cursor')
+    if cursor:
+        cursor = decode_cursor(cursor, columns)
+    return min(limit, MAX_PAGE_SIZE), cursor
+
+
+def encode_cursor(values):
+    raw = json.dumps([value.isoformat() if isinstance(value, datetime)
+                      else value for value in values])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def cursor_value(column, value):
+    # value as column's Python type, raising ValueError when it isn't one
+    python_type = column.type.python_type
+    if python_type is datetime and isinstance(value, str):
+        return datetime.fromisoformat(value)
+    if python_type is float and type(value) in (int, float) and \
+            math.isfinite(value):
+        return float(value)
+    if type(value) is not python_type or python_type is datetime:
+        raise ValueError(value)
+    return value
+
+
+def decode_cursor(cursor, columns):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError(cursor)
+        return [cursor_value(column, value)
+                for column, value in zip(columns, values)]
+    except (TypeError, ValueError, UnicodeError):
+        abort(422)
+
+
+def paginate(query, columns, limit, cursor=None, descending=False, key=None):
+    '''
+    Returns (rows, next_cursor) for one page of query ordered by columns.
+    columns must be unique together, e.g. (Article.date_created, Article.id),
+    and cursor is the decoded value list returned by page_args. key maps a
+    row to its cursor values when they aren't attributes named like columns.
+    '''
+    if cursor:
+        # Bind with the column types so values compare like stored ones
+        sort_key = tuple_(*columns)
+        values = tuple_(*[literal(value, column.type)
+                          for column, value in zip(columns, cursor)])
+        query = query.filter(
+            sort_key < values if descending else sort_key > values)
+
+    order = [column.desc() if descending else column for column in columns]
+    rows = query.order_by(*order).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        if key is None:
+            values = [getattr(last, column.key) for column in columns]
+        else:
+            values = key(last)
+        next_cursor = encode_cursor(values)
+    return rows, next_cursor
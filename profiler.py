@@ -0,0 +1,120 @@
+import os
+import time
+import heapq
+import random
+import logging
+from contextvars import ContextVar
+from flask import _request_ctx_stack
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from database import env_flag
+
+
+'''
+SQL PROFILER
+Opt in with DB_PROFILE=true. Every request then counts its queries and
+their time, returned in the X-DB-Queries and X-DB-Time (ms) headers, and
+keeps its slowest statements. A statement run DB_PROFILE_REPEAT_THRESHOLD
+times or more in one request, with any parameters, is logged as a likely
+N+1 query. Statements slower than DB_PROFILE_SLOW_MS are logged, sampled
+at DB_PROFILE_SAMPLE_RATE. Parameters are never logged.
+'''
+
+DB_PROFILE = env_flag('DB_PROFILE', False)
+DB_PROFILE_SLOW_MS = float(os.environ.get('DB_PROFILE_SLOW_MS', 100))
+DB_PROFILE_SAMPLE_RATE = float(os.environ.get('DB_PROFILE_SAMPLE_RATE', 1))
+DB_PROFILE_REPEAT_THRESHOLD = int(
+    os.environ.get('DB_PROFILE_REPEAT_THRESHOLD', 3))
+DB_PROFILE_SLOWEST = int(os.environ.get('DB_PROFILE_SLOWEST', 5))
+
+logger = logging.getLogger(__name__)
+
+
+class QueryProfile:
+    # The queries of one request
+    def __init__(self, endpoint, slowest=DB_PROFILE_SLOWEST):
+        self.endpoint = endpoint
+        self.count = 0
+        self.total = 0.0
+        self.statements = {}
+        self._slowest = []
+        self._keep = slowest
+
+    def add(self, statement, seconds):
+        self.count += 1
+        self.total += seconds
+        self.statements[statement] = self.statements.get(statement, 0) + 1
+        # Min-heap of the slowest (seconds, order, statement)
+        entry = (seconds, self.count, statement)
+        if len(self._slowest) < self._keep:
+            heapq.heappush(self._slowest, entry)
+        elif seconds > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, entry)
+
+    def slowest(self):
+        return [(statement, seconds) for seconds, _, statement
+                in sorted(self._slowest, reverse=True)]
+
+    def repeated(self, threshold=DB_PROFILE_REPEAT_THRESHOLD):
+        return [(statement, count) for statement, count
+                in self.statements.items() if count >= threshold]
+
+
+current_profile = ContextVar('current_profile', default=None)
+
+
+def start_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info['profile_started'] = time.perf_counter()
+
+
+def end_query(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop('profile_started', None)
+    profile = current_profile.get()
+    if profile is None or started is None:
+        return
+    seconds = time.perf_counter() - started
+    profile.add(statement, seconds)
+    if seconds * 1000 >= DB_PROFILE_SLOW_MS and \
+            random.random() < DB_PROFILE_SAMPLE_RATE:
+        logger.warning('slow query in %s: %.1f ms: %s', profile.endpoint,
+                       seconds * 1000, statement)
+
+
+def setup_profiler(app, enabled=None):
+    if not (DB_PROFILE if enabled is None else enabled):
+        return
+    # Listeners are only added when profiling, so it costs nothing when off
+    if not event.contains(Engine, 'before_cursor_execute', start_query):
+        event.listen(Engine, 'before_cursor_execute', start_query)
+        event.listen(Engine, 'after_cursor_execute', end_query)
+
+    @app.before_request
+    def start_profile():
+        rule = _request_ctx_stack.top.request.url_rule
+        current_profile.set(QueryProfile(
+            rule.endpoint if rule else 'unmatched'))
+
+    @app.after_request
+    def add_profile_headers(response):
+        profile = current_profile.get()
+        if profile is not None:
+            response.headers['X-DB-Queries'] = str(profile.count)
+            response.headers['X-DB-Time'] = '{:.2f}'.format(
+                profile.total * 1000)
+        return response
+
+    @app.teardown_request
+    def end_profile(exc):
+        profile = current_profile.get()
+        if profile is None:
+            return
+        current_profile.set(None)
+        for statement, count in profile.repeated():
+            logger.warning('possible N+1 in %s: %d x %s',
+                           profile.endpoint, count, statement)
+        if profile.count:
+            logger.info('%s: %d queries, %.2f ms, slowest %s',
+                        profile.endpoint, profile.count,
+                        profile.total * 1000, [
+                            '{:.2f} ms {}'.format(seconds * 1000, statement)
+                            for statement, seconds in profile.slowest()])
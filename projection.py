@@ -0,0 +1,32 @@
+from flask import request, abort
+from sqlalchemy.orm import load_only
+
+
+'''
+SPARSE FIELDSETS
+GET endpoints take ?fields=title,date_created to select and serialize only
+the listed columns of a model.
+'''
+
+
+def field_args(model):
+    # Returns the requested field names, or None to serialize the default set
+    fields = request.args.get('fields')
+    if not fields:
+        return None
+    fields = [field.strip() for field in fields.split(',') if field.strip()]
+    if not fields or any(field not in model.FIELDS for field in fields):
+        abort(422)
+    return fields
+
+
+def load_fields(query, model, fields, required=()):
+    '''
+    Restricts the SELECT list of query to fields. required names columns the
+    query itself needs, e.g. the keyset pagination columns.
+    '''
+    if not fields:
+        return query
+    columns = [getattr(model, name) for name in
+               dict.fromkeys(list(fields) + list(required))]
+    return query.options(load_only(*columns))
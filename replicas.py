@@ -0,0 +1,208 @@
+import os
+import time
+import hashlib
+import threading
+import itertools
+from functools import wraps
+from flask import (
+    g, request, current_app, has_app_context, _request_ctx_stack)
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, orm
+from sqlalchemy.pool import QueuePool
+from database import engine_options
+
+
+'''
+READ REPLICAS
+GET routes decorated with read_replica run their queries on a replica;
+everything else, and any flush, stays on the primary:
+
+    DATABASE_REPLICA_URLS       comma separated replica URLs (default none)
+    DB_REPLICA_STRATEGY         round_robin or least_connections
+    DB_READ_YOUR_WRITES_SECONDS after a write the caller reads from the
+                                primary for this long (default 5)
+    DB_PRIMARY_PINS_DIR         directory the workers of a server share
+                                those callers through (gunicorn.conf.py
+                                creates one; without it a bearer token
+                                client is only pinned on the worker that
+                                served its write)
+'''
+
+DATABASE_REPLICA_URLS = [
+    url.strip() for url in
+    os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+DB_REPLICA_STRATEGY = os.environ.get('DB_REPLICA_STRATEGY', 'round_robin')
+DB_READ_YOUR_WRITES_SECONDS = float(
+    os.environ.get('DB_READ_YOUR_WRITES_SECONDS', 5))
+DB_PRIMARY_PINS_DIR = os.environ.get('DB_PRIMARY_PINS_DIR')
+# Cookie that pins a browser to the primary across workers
+PRIMARY_COOKIE = 'db_primary_until'
+
+
+class ReplicaSet:
+    def __init__(self, urls, strategy='round_robin'):
+        if strategy not in ('round_robin', 'least_connections'):
+            raise ValueError('unknown replica strategy: ' + strategy)
+        self.urls = urls
+        self.strategy = strategy
+        self.engines = [create_engine(url, **engine_options(url))
+                        for url in urls]
+        self._counter = itertools.count()
+
+    def __bool__(self):
+        return bool(self.engines)
+
+    def choose(self):
+        if not self.engines:
+            return None
+        if self.strategy == 'least_connections':
+            return min(self.engines, key=checked_out)
+        return self.engines[next(self._counter) % len(self.engines)]
+
+    def dispose(self):
+        for engine in self.engines:
+            engine.dispose()
+
+
+def checked_out(engine):
+    pool = engine.pool
+    return pool.checkedout() if isinstance(pool, QueuePool) else 0
+
+
+class PrimaryPins:
+    '''
+    Token subjects that wrote recently and must read from the primary.
+    With a directory, every pin is also a file whose mtime is the end of
+    the pin, so the other workers of the server see it with one stat.
+    '''
+    def __init__(self, window, max_size=10000, directory=None):
+        self.window = window
+        self.max_size = max_size
+        self.directory = directory
+        self._until = {}
+        self._files = 0
+        self._lock = threading.Lock()
+
+    def pin(self, subject, now=None):
+        now = time.time() if now is None else now
+        until = now + self.window
+        with self._lock:
+            if len(self._until) >= self.max_size:
+                self._until = {key: until for key, until
+                               in self._until.items() if until > now}
+            self._until[subject] = until
+        if self.directory:
+            self._pin_file(subject, until, now)
+        return until
+
+    def is_pinned(self, subject, now=None):
+        now = time.time() if now is None else now
+        until = self._until.get(subject)
+        if until is not None and until > now:
+            return True
+        if self.directory:
+            try:
+                return os.stat(self._path(subject)).st_mtime > now
+            except OSError:
+                pass
+        return False
+
+    def _path(self, subject):
+        return os.path.join(self.directory, hashlib.sha1(
+            subject.encode('utf-8')).hexdigest())
+
+    def _pin_file(self, subject, until, now):
+        path = self._path(subject)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path, 'a'):
+                pass
+            os.utime(path, (until, until))
+        except OSError:
+            # Still pinned on this worker
+            return
+        self._files += 1
+        if self._files >= self.max_size:
+            self._files = 0
+            self._prune(now)
+
+    def _prune(self, now):
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.stat().st_mtime <= now:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+
+pins = PrimaryPins(DB_READ_YOUR_WRITES_SECONDS,
+                   directory=DB_PRIMARY_PINS_DIR)
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        # A replica chosen for this request serves its reads; flushes never
+        # leave the primary
+        replica = g.get('db_replica') if has_app_context() else None
+        if replica is not None and not self._flushing:
+            return replica
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def current_subject():
+    user = getattr(_request_ctx_stack.top, 'current_user', None)
+    return user.get('sub') if isinstance(user, dict) else None
+
+
+def primary_pinned():
+    try:
+        if float(request.cookies.get(PRIMARY_COOKIE, 0)) > time.time():
+            return True
+    except ValueError:
+        pass
+    subject = current_subject()
+    return subject is not None and pins.is_pinned(subject)
+
+
+def read_replica(f):
+    # Route the request's reads to a replica unless the caller just wrote
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        replicas = current_app.extensions.get('db_replicas')
+        if replicas and not primary_pinned():
+            g.db_replica = replicas.choose()
+        return f(*args, **kwargs)
+
+    return wrapper
+
+
+def pin_after_write(response):
+    '''
+    after_request hook: a successful write pins its caller to the primary
+    for DB_READ_YOUR_WRITES_SECONDS, so it reads what it just wrote even
+    while the replicas lag.
+    '''
+    if request.method in ('GET', 'HEAD', 'OPTIONS') or \
+            response.status_code >= 400 or DB_READ_YOUR_WRITES_SECONDS <= 0:
+        return response
+    subject = current_subject()
+    if subject is not None:
+        until = pins.pin(subject)
+    else:
+        until = time.time() + DB_READ_YOUR_WRITES_SECONDS
+    response.set_cookie(PRIMARY_COOKIE, '{:.3f}'.format(until),
+                        max_age=int(DB_READ_YOUR_WRITES_SECONDS) + 1,
+                        httponly=True)
+    return response
+
+
+def setup_replicas(app, urls=None, strategy=None):
+    app.extensions['db_replicas'] = ReplicaSet(
+        DATABASE_REPLICA_URLS if urls is None else urls,
+        strategy or DB_REPLICA_STRATEGY)
+    return app.extensions['db_replicas']
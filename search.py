@@ -0,0 +1,53 @@
+import re
+from flask import request, abort
+from sqlalchemy import Float, cast, false, literal_column, table, column
+from sqlalchemy.sql import func
+from models import db, Article
+
+
+'''
+ARTICLE SEARCH
+GET /articles/search?q= matches q against article titles and content
+through the full-text index (see ARTICLE_SEARCH_DDL in models) and ranks
+title matches above content matches.
+'''
+
+# SQLite bm25 weights per FTS5 column (title, content)
+SQLITE_TITLE_WEIGHT = 10.0
+SQLITE_CONTENT_WEIGHT = 1.0
+
+articles_fts = table('articles_fts', column('rowid'))
+
+
+def search_args():
+    # Returns the search text, aborting when there is none
+    q = request.args.get('q', '').strip()
+    if not q:
+        abort(422)
+    return q
+
+
+def search_query(query, q):
+    '''
+    Restricts query to articles matching q. Returns (query, rank), where
+    rank is the relevance of a row, higher for better matches.
+    '''
+    if db.session.get_bind().dialect.name == 'postgresql':
+        # websearch_to_tsquery accepts any user input: quotes, or, -term
+        tsquery = func.websearch_to_tsquery('english', q)
+        vector = literal_column('articles.search_vector')
+        # ts_rank is a real; as a double precision the rank a cursor sends
+        # back compares equal to the one selected, so ties page correctly
+        rank = cast(func.ts_rank(vector, tsquery), Float(precision=53))
+        return query.filter(vector.op('@@')(tsquery)), rank
+
+    # FTS5: every word must match; quoting keeps its syntax out of user input
+    terms = re.findall(r'\w+', q)
+    rank = -func.bm25(literal_column('articles_fts'),
+                      SQLITE_TITLE_WEIGHT, SQLITE_CONTENT_WEIGHT,
+                      type_=Float)
+    query = query.join(articles_fts, articles_fts.c.rowid == Article.id)
+    if not terms:
+        return query.filter(false()), rank
+    return query.filter(literal_column('articles_fts').match(
+        ' '.join('"{}"'.format(term) for term in terms))), rank
@@ -0,0 +1,95 @@
+import json
+import time
+from decimal import Decimal
+from datetime import date, datetime, timezone
+from operator import attrgetter
+from flask import Response
+from flask.json import JSONEncoder as FlaskJSONEncoder
+from metrics import add_time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+'''
+JSON SERIALIZATION
+dumps() encodes with orjson when it is installed and falls back to the
+stdlib encoder. Datetimes keep the HTTP date format jsonify has always
+produced, e.g. "Wed, 31 Mar 2021 18:25:26 GMT".
+'''
+
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+          'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
+def http_date(value):
+    # Same output as werkzeug.http.http_date at a fraction of the cost
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc)
+        hour, minute, second = value.hour, value.minute, value.second
+    else:
+        hour = minute = second = 0
+    return '%s, %02d %s %04d %02d:%02d:%02d GMT' % (
+        WEEKDAYS[value.weekday()], value.day, MONTHS[value.month - 1],
+        value.year, hour, minute, second)
+
+
+def default(value):
+    if isinstance(value, date):
+        return http_date(value)
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError('Object of type {} is not JSON serializable'.format(
+        type(value).__name__))
+
+
+if orjson is not None:
+    ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME
+
+    def dumps(value):
+        return orjson.dumps(value, default=default, option=ORJSON_OPTIONS)
+else:
+    _encode = json.JSONEncoder(default=default, separators=(',', ':')).encode
+
+    def dumps(value):
+        return _encode(value).encode('utf-8')
+
+
+class JSONEncoder(FlaskJSONEncoder):
+    # Used by jsonify for the routes that don't go through json_response
+    def default(self, value):
+        if isinstance(value, date):
+            return http_date(value)
+        return super().default(value)
+
+
+def json_response(payload, status=200):
+    started = time.perf_counter()
+    body = dumps(payload)
+    add_time('serialization', time.perf_counter() - started)
+    return Response(body, status=status, mimetype='application/json')
+
+
+def serialize_rows(rows, keys):
+    '''
+    Turns column tuples from Query.with_entities() into JSON-ready objects
+    holding keys, without loading ORM instances.
+    '''
+    started = time.perf_counter()
+    if len(keys) == 1:
+        key = keys[0]
+        data = [{key: getattr(row, key)} for row in rows]
+    else:
+        values = attrgetter(*keys)
+        data = [dict(zip(keys, values(row))) for row in rows]
+    add_time('serialization', time.perf_counter() - started)
+    return data
+
+
+def serialize_records(records, keys):
+    # serialize_rows for rows read by column name, e.g. asyncpg records
+    return [{key: record[key] for key in keys} for record in records]
@@ -0,0 +1,396 @@
+import io
+import csv
+import time
+import random
+import multiprocessing
+from datetime import datetime, timedelta
+from itertools import accumulate
+from sqlalchemy import create_engine, select, func, and_, true, text
+from sqlalchemy.pool import NullPool
+from models import Nutritionist, Client, Article, Subscription, ClientFeed
+
+
+'''
+SYNTHETIC DATA
+Generates nutritionists, clients, their articles and subscriptions from a
+seed. Work is split into chunks of entities and every chunk draws from its
+own generator seeded by (seed, table, chunk), so the same seed and sizes
+give the same rows whatever the number of worker processes. Articles
+and subscriptions get explicit ids too: every chunk's rows are counted
+first, so a chunk's ids don't depend on when its worker commits. PostgreSQL
+tables are loaded with COPY, other databases with batched executemany.
+New rows only reference rows generated in the same run, so data can be
+added to a database that already has some.
+'''
+
+DISTRIBUTIONS = ('constant', 'uniform', 'exponential', 'pareto')
+CHUNK_SIZE = 10000
+BATCH_SIZE = 5000
+PARETO_ALPHA = 1.5
+WORDS = ('protein fibre vitamin mineral hydration sugar sodium iron calcium '
+         'breakfast lunch dinner snack vegan keto fasting gut sleep energy '
+         'recovery diet meal plan recipe portion balance heart weight '
+         'muscle immune').split()
+SPECIALIZATIONS = ('sports', 'clinical', 'paediatric', 'public health',
+                   'weight management', 'renal', 'oncology', 'geriatric')
+COUNTRIES = ('NG', 'GH', 'KE', 'ZA', 'GB', 'US', 'CA', 'IN', 'DE', 'BR')
+
+TABLES = {
+    'nutritionists': (Nutritionist.__table__, (
+        'id', 'name', 'specialization', 'rating', 'email', 'rating_sum',
+        'rating_count', 'rating_average', 'subscriber_count')),
+    'clients': (Client.__table__, ('id', 'name', 'country', 'email')),
+    'articles': (Article.__table__, (
+        'id', 'title', 'date_created', 'content', 'nutritionist_id')),
+    'subscriptions': (Subscription.__table__, (
+        'id', 'nutritionist_id', 'client_id', 'subscription_status'))
+}
+
+
+class Plan:
+    # What to generate; first_* are the ids the new rows start from
+    def __init__(self, seed=0, nutritionists=1000, clients=10000,
+                 articles_per_nutritionist=50,
+                 article_distribution='pareto',
+                 subscriptions_per_client=3,
+                 subscription_distribution='exponential',
+                 popularity=1.0, content_words=80,
+                 start=datetime(2021, 1, 1), days=365, feed=True):
+        for distribution in (article_distribution,
+                             subscription_distribution):
+            if distribution not in DISTRIBUTIONS:
+                raise ValueError('unknown distribution {!r}, use one of {}'
+                                 .format(distribution, DISTRIBUTIONS))
+        self.seed = seed
+        self.nutritionists = nutritionists
+        self.clients = clients
+        self.articles_per_nutritionist = articles_per_nutritionist
+        self.article_distribution = article_distribution
+        self.subscriptions_per_client = subscriptions_per_client
+        self.subscription_distribution = subscription_distribution
+        self.popularity = popularity
+        self.content_words = content_words
+        self.start = start
+        self.days = days
+        self.feed = feed
+        self.first_nutritionist = 1
+        self.first_client = 1
+        self.first_article = 1
+        self.first_subscription = 1
+        # table -> id of the first row of each chunk, see first_id
+        self.chunk_ids = {}
+
+    def entities(self, table_name):
+        # Articles are generated per nutritionist, subscriptions per client
+        if table_name in ('nutritionists', 'articles'):
+            return self.nutritionists
+        return self.clients
+
+    def first_id(self, table_name, chunk):
+        # Id of the first row of chunk in articles or subscriptions, after
+        # the rows of every chunk before it
+        if table_name not in self.chunk_ids:
+            first = self.first_article if table_name == 'articles' \
+                else self.first_subscription
+            self.chunk_ids[table_name] = list(accumulate(
+                [first] + [COUNTS[table_name](self, other) for other
+                           in chunks(self.entities(table_name))]))
+        return self.chunk_ids[table_name][chunk]
+
+
+def draw(rng, distribution, mean):
+    # A non-negative count with the given mean
+    if mean <= 0:
+        return 0
+    if distribution == 'constant':
+        return int(mean)
+    if distribution == 'uniform':
+        return rng.randint(0, int(2 * mean))
+    if distribution == 'exponential':
+        return int(round(rng.expovariate(1.0 / mean)))
+    # Pareto with scale set so the mean comes out right: a long tail of
+    # prolific authors over a majority who write little
+    scale = mean * (PARETO_ALPHA - 1) / PARETO_ALPHA
+    return int(scale * rng.paretovariate(PARETO_ALPHA))
+
+
+def chunk_random(plan, table, chunk):
+    return random.Random('{}:{}:{}'.format(plan.seed, table, chunk))
+
+
+_popularity = {}
+
+
+def popularity_weights(count, exponent):
+    # Cumulative Zipf weights: the k-th nutritionist is chosen with weight
+    # 1 / k ** exponent, so a few are subscribed to by many clients
+    key = (count, exponent)
+    if key not in _popularity:
+        _popularity.clear()
+        _popularity[key] = list(accumulate(
+            1.0 / (k ** exponent) for k in range(1, count + 1)))
+    return _popularity[key]
+
+
+def sentence(rng, words):
+    return ' '.join(rng.choices(WORDS, k=words))
+
+
+'''
+ROW GENERATORS
+Each yields the rows of chunk, a range of CHUNK_SIZE entities, as tuples
+in the column order of TABLES.
+'''
+
+
+def nutritionist_rows(plan, chunk):
+    rng = chunk_random(plan, 'nutritionists', chunk)
+    for i in chunk_range(chunk, plan.nutritionists):
+        id = plan.first_nutritionist + i
+        yield (id, 'Nutritionist {}'.format(id),
+               rng.choice(SPECIALIZATIONS), 0,
+               'nutritionist{}@example.com'.format(id), 0, 0, 0.0, 0)
+
+
+def client_rows(plan, chunk):
+    rng = chunk_random(plan, 'clients', chunk)
+    for i in chunk_range(chunk, plan.clients):
+        id = plan.first_client + i
+        yield (id, 'Client {}'.format(id), rng.choice(COUNTRIES),
+               'client{}@example.com'.format(id))
+
+
+def article_counts(plan, chunk):
+    # Articles per nutritionist of the chunk, drawn apart from their text
+    # so counting a chunk stays cheap
+    rng = chunk_random(plan, 'article counts', chunk)
+    return [draw(rng, plan.article_distribution,
+                 plan.articles_per_nutritionist)
+            for _ in chunk_range(chunk, plan.nutritionists)]
+
+
+def article_rows(plan, chunk):
+    # Articles of the chunk's nutritionists
+    rng = chunk_random(plan, 'articles', chunk)
+    seconds = plan.days * 86400
+    id = plan.first_id('articles', chunk)
+    for i, count in zip(chunk_range(chunk, plan.nutritionists),
+                        article_counts(plan, chunk)):
+        nutritionist_id = plan.first_nutritionist + i
+        for _ in range(count):
+            yield (id, sentence(rng, rng.randint(3, 8)).capitalize(),
+                   plan.start + timedelta(seconds=rng.randrange(seconds)),
+                   sentence(rng, plan.content_words), nutritionist_id)
+            id += 1
+
+
+def subscription_choices(plan, chunk):
+    # (client id, nutritionist ids) of the chunk's clients
+    rng = chunk_random(plan, 'subscriptions', chunk)
+    ids = range(plan.first_nutritionist,
+                plan.first_nutritionist + plan.nutritionists)
+    weights = popularity_weights(plan.nutritionists, plan.popularity)
+    for i in chunk_range(chunk, plan.clients):
+        count = min(plan.nutritionists, draw(
+            rng, plan.subscription_distribution,
+            plan.subscriptions_per_client))
+        yield plan.first_client + i, sorted(set(
+            rng.choices(ids, cum_weights=weights, k=count)))
+
+
+def subscription_rows(plan, chunk):
+    # Subscriptions of the chunk's clients
+    id = plan.first_id('subscriptions', chunk)
+    for client_id, chosen in subscription_choices(plan, chunk):
+        for nutritionist_id in chosen:
+            yield (id, nutritionist_id, client_id, True)
+            id += 1
+
+
+ROWS = {
+    'nutritionists': nutritionist_rows,
+    'clients': client_rows,
+    'articles': article_rows,
+    'subscriptions': subscription_rows
+}
+
+# Rows a chunk of articles or subscriptions has, without generating them
+COUNTS = {
+    'articles': lambda plan, chunk: sum(article_counts(plan, chunk)),
+    'subscriptions': lambda plan, chunk: sum(
+        len(chosen) for _, chosen in subscription_choices(plan, chunk))
+}
+
+
+def chunk_range(chunk, total):
+    return range(chunk * CHUNK_SIZE, min((chunk + 1) * CHUNK_SIZE, total))
+
+
+def chunks(total):
+    return range((total + CHUNK_SIZE - 1) // CHUNK_SIZE)
+
+
+'''
+WRITERS
+'''
+
+
+def copy_rows(connection, table, columns, rows):
+    # PostgreSQL COPY in CSV, one buffer per BATCH_SIZE rows
+    cursor = connection.connection.cursor()
+    sql = 'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+        table.name, ', '.join(columns))
+    count = 0
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+        if count % BATCH_SIZE == 0:
+            buffer.seek(0)
+            cursor.copy_expert(sql, buffer)
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        buffer.seek(0)
+        cursor.copy_expert(sql, buffer)
+    return count
+
+
+def insert_rows(connection, table, columns, rows):
+    count = 0
+    batch = []
+    for row in rows:
+        batch.append(dict(zip(columns, row)))
+        if len(batch) == BATCH_SIZE:
+            connection.execute(table.insert(), batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        connection.execute(table.insert(), batch)
+        count += len(batch)
+    return count
+
+
+_engine = None
+
+
+def worker_engine(url):
+    # One engine per process; forked workers never reuse the parent's
+    global _engine
+    if _engine is None or str(_engine.url) != url:
+        _engine = create_engine(url, poolclass=NullPool)
+    return _engine
+
+
+def load_chunk(task):
+    url, plan, table_name, chunk = task
+    table, columns = TABLES[table_name]
+    engine = worker_engine(url)
+    with engine.begin() as connection:
+        write = copy_rows if engine.dialect.name == 'postgresql' \
+            else insert_rows
+        return table_name, write(connection, table, columns,
+                                 ROWS[table_name](plan, chunk))
+
+
+def derive_chunk(task):
+    # Subscriber counts and client feed of a chunk of new nutritionists
+    url, plan, _, chunk = task
+    ids = chunk_range(chunk, plan.nutritionists)
+    first = plan.first_nutritionist + ids.start
+    last = plan.first_nutritionist + ids.stop - 1
+    nutritionists = Nutritionist.__table__
+    active = select([func.count(Subscription.id)]).where(and_(
+        Subscription.nutritionist_id == nutritionists.c.id,
+        Subscription.subscription_status == true())).as_scalar()
+    engine = worker_engine(url)
+    with engine.begin() as connection:
+        connection.execute(nutritionists.update().where(
+            nutritionists.c.id.between(first, last)).values(
+                subscriber_count=active))
+        count = 0
+        if plan.feed:
+            count = connection.execute(
+                ClientFeed.__table__.insert().from_select(
+                    ['client_id', 'article_id', 'date_created'],
+                    ClientFeed.expected(
+                        Article.nutritionist_id.between(first, last)))
+            ).rowcount
+    return 'client_feed', count
+
+
+def run(name, tasks, function, workers, log):
+    # Runs tasks, returning {table: rows} and logging the rate
+    started = time.perf_counter()
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            results = list(pool.imap_unordered(function, tasks))
+    else:
+        results = [function(task) for task in tasks]
+    elapsed = time.perf_counter() - started
+    totals = {}
+    for table_name, count in results:
+        totals[table_name] = totals.get(table_name, 0) + count
+    rows = sum(totals.values())
+    log('{}: {} rows in {:.1f} s ({:.0f} rows/s)'.format(
+        name, rows, elapsed, rows / elapsed if elapsed else 0))
+    return totals
+
+
+def next_id(connection, table):
+    return (connection.execute(select([func.max(table.c.id)])).scalar()
+            or 0) + 1
+
+
+def prepare(connection, plan):
+    # Sets the ids plan's rows start from, before any task is handed out
+    plan.first_nutritionist = next_id(connection, Nutritionist.__table__)
+    plan.first_client = next_id(connection, Client.__table__)
+    plan.first_article = next_id(connection, Article.__table__)
+    plan.first_subscription = next_id(connection, Subscription.__table__)
+    plan.chunk_ids = {}
+    for table_name in ('articles', 'subscriptions'):
+        plan.first_id(table_name, 0)
+
+
+def generate(url, plan, workers=1, log=print):
+    '''
+    Adds plan's rows to the database at url with workers processes and
+    returns {table: rows}. SQLite always uses one process, since it takes
+    one writer at a time.
+    '''
+    engine = create_engine(url, poolclass=NullPool)
+    if engine.dialect.name == 'sqlite':
+        workers = 1
+    with engine.begin() as connection:
+        prepare(connection, plan)
+
+    started = time.perf_counter()
+    totals = {}
+    # Parents first: articles and subscriptions reference them
+    for table_name in ('nutritionists', 'clients', 'articles',
+                       'subscriptions'):
+        totals.update(run(table_name, [
+            (url, plan, table_name, chunk)
+            for chunk in chunks(plan.entities(table_name))
+        ], load_chunk, workers, log))
+    totals.update(run('subscriber counts and client_feed', [
+        (url, plan, None, chunk) for chunk in chunks(plan.nutritionists)
+    ], derive_chunk, workers, log))
+
+    with engine.begin() as connection:
+        if engine.dialect.name == 'postgresql':
+            # The ids were set explicitly, so move the sequences past them
+            for table, _ in TABLES.values():
+                connection.execute(text(
+                    "SELECT setval(pg_get_serial_sequence(:table, 'id'), "
+                    "(SELECT max(id) FROM {}))".format(table.name)),
+                    table=table.name)
+    engine.dispose()
+
+    elapsed = time.perf_counter() - started
+    rows = sum(totals.values())
+    log('total: {} rows in {:.1f} s ({:.0f} rows/s)'.format(
+        rows, elapsed, rows / elapsed if elapsed else 0))
+    return totals
@@ -1,11 +1,38 @@
 import os
+import time
+import shutil
+import tempfile
 import unittest
 import json
+import sqlite3
+import rsa
+from jose import jwt
+from sqlalchemy import exc
 from flask_sqlalchemy import SQLAlchemy
-from models import setup_db, Nutritionist, Client, Article, Subscription
+from models import setup_db, db, Nutritionist, Client, Article, Subscription, \
+    ClientFeed, OutboxEvent, ResourceVersion
+import outbox
 from flask import Flask
 from app import create_app
+import auth.auth
+from auth.jwks import JWKSCache
+from auth.token_cache import TokenCache
+from replicas import ReplicaSet, PrimaryPins
+from metrics import Registry, setup_metrics, start_timer, end_timer, \
+    current_timer
+from profiler import QueryProfile
+from admission import AdmissionController, queue_time
+from database import TimedQueuePool
+import compression
+from compression import compress_response
+import synthetic
+try:
+    import asgi
+except ImportError:
+    asgi = None
 from datetime import datetime
+import gzip
+import zlib
 import base64
 from base64 import b64encode
 
@@ -23,9 +50,8 @@ class CapstoneTest(unittest.TestCase):
         
         # binds the app to the current context
         with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
+            self.db = db
+            # create all tables, setup_db leaves the schema to migrations
             self.db.create_all()
 
     def tearDown(self):
@@ -40,6 +66,26 @@ class CapstoneTest(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['val'], 'Halos')
 
+    def test_pool_stats(self):
+        res = self.client().get('/pool')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['data']['pool'])
+
+    def test_metrics(self):
+        self.client().get('/')
+        res = self.client().get('/metrics')
+        text = res.get_data(as_text=True)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.content_type.startswith('text/plain'))
+        self.assertIn('capstone_http_requests_total{endpoint="get_initial",'
+                      'method="GET",status="200"}', text)
+        self.assertIn('capstone_http_requests_in_flight{endpoint='
+                      '"get_metrics"} 1', text)
+
     '''
         TEST FOR NUTRITIONISTS
     '''
@@ -54,6 +100,27 @@ class CapstoneTest(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(data['email'])
 
+    # Test to create Nutritionists in bulk
+    def test_create_nutritionists_bulk(self):
+        res = self.client().post('/nutritionists/bulk',
+                                 json=[{'name': 'Bulk One', 'specialization': 'Pediatrics', 'email': 'bulk1@test.com'},
+                                       {'name': 'Bulk Two', 'specialization': 'Sports', 'email': 'bulk2@test.com'},
+                                       {'name': 'No Email', 'specialization': 'Sports'}], headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], 2)
+        self.assertEqual(data['failed'], 1)
+        self.assertFalse(data['results'][2]['success'])
+
+    def test_422_create_nutritionists_bulk_empty(self):
+        res = self.client().post('/nutritionists/bulk', json=[],
+                                 headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
     # Get All Nutritionists
     def test_get_all_nutritionists(self):
         res = self.client().get('/nutritionists',
@@ -64,6 +131,57 @@ class CapstoneTest(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(data['data'])
 
+    # Lists are shed while the request queued too long before the worker
+    def test_503_get_nutritionists_shed(self):
+        headers = dict(self.headers, **{'X-Request-Start': 't={}'.format(
+            int((time.time() - 5) * 1000))})
+        res = self.client().get('/nutritionists', headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(res.headers['Retry-After'], '1')
+
+    # Get Nutritionists page by page
+    def test_paginate_nutritionists(self):
+        res = self.client().get('/nutritionists?limit=1', headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['data']), 1)
+        self.assertTrue(data['next_cursor'])
+
+        res = self.client().get('/nutritionists?limit=1&cursor={}'.format(
+            data['next_cursor']), headers=self.headers)
+        next_page = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertGreater(next_page['data'][0]['id'], data['data'][0]['id'])
+
+    def test_422_invalid_cursor(self):
+        res = self.client().get('/nutritionists?cursor=invalid',
+                                headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    # Cursors of the right length but the wrong types, on every list
+    def test_422_ill_typed_cursor(self):
+        cursors = [base64.urlsafe_b64encode(json.dumps(values).encode())
+                   .decode() for values in ([[1]], ['x'], ['abc', 1],
+                                            [{'a': 1}, 1], [True, 1],
+                                            [1, 'x'], [float('nan'), 1])]
+        for path in ('/nutritionists?', '/clients?', '/nutritionists/top?',
+                     '/nutritionists/top?by=subscribers&', '/articles?',
+                     '/articles?client_id=1&', '/articles?nutritionist_id=1&',
+                     '/articles/search?q=kombucha&'):
+            for cursor in cursors:
+                res = self.client().get(path + 'cursor=' + cursor,
+                                        headers=self.headers)
+
+                self.assertEqual(res.status_code, 422, (path, cursor))
+
     # def test_404_get_all_nutritionists(self):
     #     res = self.client().get('/nutritionists', headers=self.headers)
     #     data = json.loads(res.data)
@@ -80,6 +198,30 @@ class CapstoneTest(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
 
+    def test_get_nutritionist_fields(self):
+        res = self.client().get('/nutritionists/1?fields=name,email',
+                                headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(set(data['data']), {'name', 'email'})
+
+    def test_304_get_specific_nutritionist(self):
+        res = self.client().get('/nutritionists/1', headers=self.headers)
+        etag = res.headers['ETag']
+        res = self.client().get('/nutritionists/1', headers=dict(
+            self.headers, **{'If-None-Match': etag}))
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertEqual(res.headers['ETag'], etag)
+
+    def test_if_modified_since_is_ignored(self):
+        res = self.client().get('/nutritionists/1', headers=dict(
+            self.headers, **{'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'}))
+
+        self.assertEqual(res.status_code, 200)
+
     def test_404_get_specific_nutritionists(self):
         res = self.client().get('/nutritionists/80', headers=self.headers)
         data = json.loads(res.data)
@@ -97,6 +239,48 @@ class CapstoneTest(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(data['id'])
 
+    # Test to rate a nutritionist and read the leaderboard
+    def test_rate_nutritionist(self):
+        res = self.client().post('/ratings', json={
+            'nutritionist_id': 1, 'client_id': 1, 'score': 4}, headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+
+        res = self.client().get('/nutritionists/1?fields=rating_count', headers=self.headers)
+        self.assertTrue(json.loads(res.data)['data']['rating_count'])
+
+    def test_422_rate_nutritionist_out_of_range(self):
+        res = self.client().post('/ratings', json={
+            'nutritionist_id': 1, 'client_id': 1, 'score': 9}, headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    def test_top_nutritionists(self):
+        res = self.client().get('/nutritionists/top?by=subscribers&limit=3',
+                                headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertLessEqual(len(data['data']), 3)
+        counts = [row['subscriber_count'] for row in data['data']]
+        self.assertEqual(counts, sorted(counts, reverse=True))
+
+    def test_top_nutritionists_next_page(self):
+        res = self.client().get('/nutritionists/top?limit=1', headers=self.headers)
+        first = json.loads(res.data)
+        res = self.client().get('/nutritionists/top?limit=1&cursor={}'.format(
+            first['next_cursor']), headers=self.headers)
+        second = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(second['data'][0]['id'], first['data'][0]['id'])
+        self.assertGreaterEqual(first['data'][0]['rating_average'],
+                                second['data'][0]['rating_average'])
+
     def test_422_update_nutritionist(self):
         res = self.client().patch('/nutritionists',
                                   json={'id': 70, 'name': 'Smallie Brown', 'specialization': 'Pediatrics', 'email': 'smallie@test.com'}, headers=self.headers)
@@ -119,6 +303,19 @@ class CapstoneTest(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(data['email'])
 
+    def test_create_clients_bulk_rejects_bad_items(self):
+        res = self.client().post('/clients/bulk', json=[
+            {'name': 'Bulk Client', 'country': 'NG', 'email': 'bulkclient@test.com'},
+            {'name': {'first': 'Dict'}, 'country': 'NG', 'email': 'dict@test.com'},
+            {'name': 'Long Email', 'country': 'NG', 'email': 'x' * 101}],
+            headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], 1)
+        self.assertEqual([result['message'] for result in data['results'][1:]],
+                         ['name must be text', 'email is too long'])
+
     # Test to Get all Clients
     def test_get_all_clients(self):
         res = self.client().get('/clients', headers=self.headers)
@@ -184,6 +381,35 @@ class CapstoneTest(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
 
+    # Test for creating articles in bulk from NDJSON
+    def test_create_articles_bulk(self):
+        body = '\n'.join(json.dumps(article) for article in [
+            {'nutritionist': 1, 'title': 'Bulk Article', 'content': 'Lorem Ipsume'},
+            {'nutritionist': 9999, 'title': 'Orphan Article', 'content': 'Lorem Ipsume'}])
+        res = self.client().post('/articles/bulk', data=body,
+                                 content_type='application/x-ndjson', headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], 1)
+        self.assertTrue(data['results'][0]['id'])
+
+    # Test malformed bulk articles fail on their own
+    def test_create_articles_bulk_rejects_bad_items(self):
+        res = self.client().post('/articles/bulk', json=[
+            {'nutritionist': '1', 'title': 'String Author', 'content': 'Lorem Ipsume'},
+            {'nutritionist': [1], 'title': 'List Author', 'content': 'Lorem Ipsume'},
+            {'nutritionist': {}, 'title': 'Dict Author', 'content': 'Lorem Ipsume'},
+            {'nutritionist': 1, 'title': 'x' * 101, 'content': 'Lorem Ipsume'}],
+            headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], 1)
+        self.assertEqual([result['success'] for result in data['results']],
+                         [True, False, False, False])
+        self.assertEqual(data['results'][3]['message'], 'title is too long')
+
     # Test to get all articles
     def test_get_all_articles(self):
         res = self.client().get('/articles', headers=self.headers)
@@ -194,6 +420,56 @@ class CapstoneTest(unittest.TestCase):
         self.assertTrue(data['data'])
 
 
+    # Test to get only article titles
+    def test_get_article_titles(self):
+        res = self.client().get('/articles?fields=title', headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(set(data['data'][0]), {'title'})
+
+    def test_422_get_article_unknown_field(self):
+        res = self.client().get('/articles?fields=password',
+                                headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    # Test to stream all articles as NDJSON
+    def test_stream_articles(self):
+        headers = dict(self.headers, Accept='application/x-ndjson')
+        res = self.client().get('/articles', headers=headers)
+        lines = res.data.decode('utf-8').splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertTrue(lines)
+        self.assertTrue(json.loads(lines[0])['title'])
+
+
+    # Test article list is gzip compressed when accepted
+    def test_get_articles_gzip(self):
+        headers = dict(self.headers, **{'Accept-Encoding': 'gzip'})
+        res = self.client().get('/articles', headers=headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertTrue(float(res.headers['X-Compression-Ratio']) > 1)
+        self.assertEqual(json.loads(gzip.decompress(res.data))['success'], True)
+
+    # Test a 304 keeps the gzip ETag the client was given
+    def test_304_gzip_keeps_encoded_etag(self):
+        headers = dict(self.headers, **{'Accept-Encoding': 'gzip'})
+        etag = self.client().get('/articles', headers=headers).headers['ETag']
+        res = self.client().get('/articles', headers=dict(
+            headers, **{'If-None-Match': etag}))
+
+        self.assertTrue(etag.endswith('-gzip"'))
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], etag)
+
+
     # Test get articles based on client subscription
     def test_get_client_articles(self):
         res = self.client().get('/articles?client_id=1', headers=self.headers)
@@ -204,6 +480,31 @@ class CapstoneTest(unittest.TestCase):
         self.assertTrue(data['data'])
 
         
+    # Test client feed is served newest first
+    def test_client_articles_newest_first(self):
+        res = self.client().get('/articles?client_id=1&fields=date_created',
+                                headers=self.headers)
+        data = json.loads(res.data)
+        dates = [datetime.strptime(article['date_created'],
+                                   '%a, %d %b %Y %H:%M:%S GMT')
+                 for article in data['data']]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(dates, sorted(dates, reverse=True))
+
+        
+    # Test article changes invalidate the client feed ETag
+    def test_client_articles_etag_changes_after_write(self):
+        res = self.client().get('/articles?client_id=1', headers=self.headers)
+        etag = res.headers['ETag']
+        self.client().post('/articles',
+                           json={'nutritionist': 1, 'title': 'Fresh Article', 'content': 'Lorem Ipsume'}, headers=self.headers)
+        res = self.client().get('/articles?client_id=1', headers=dict(
+            self.headers, **{'If-None-Match': etag}))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
     # Test get articles created by specific nutritionist
     def test_get_nutritionist_articles(self):
         res = self.client().get('/articles?nutritionist_id=8', headers=self.headers)
@@ -214,6 +515,53 @@ class CapstoneTest(unittest.TestCase):
         self.assertTrue(data['data'])
 
 
+    # Test to search articles, title matches first
+    def test_search_articles(self):
+        self.client().post('/articles', json={
+            'nutritionist': 1, 'title': 'Kombucha Basics',
+            'content': 'Fermented tea'}, headers=self.headers)
+        self.client().post('/articles', json={
+            'nutritionist': 1, 'title': 'Gut Health',
+            'content': 'Kombucha and kefir'}, headers=self.headers)
+        res = self.client().get('/articles/search?q=kombucha&fields=title',
+                                headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['data'][0]['title'], 'Kombucha Basics')
+
+    # Articles of equal rank are paged without repeats or gaps
+    def test_search_articles_pages_tied_ranks(self):
+        with self.app.app_context():
+            if db.engine.dialect.name != 'postgresql':
+                self.skipTest('ranks ties with PostgreSQL full-text search')
+        for _ in range(3):
+            self.client().post('/articles', json={
+                'nutritionist': 1, 'title': 'Tigernut Milk',
+                'content': 'Tigernut milk'}, headers=self.headers)
+        ids = []
+        cursor = ''
+        for _ in range(10):
+            res = self.client().get(
+                '/articles/search?q=tigernut&fields=id&limit=1' + cursor,
+                headers=self.headers)
+            data = json.loads(res.data)
+            ids += [article['id'] for article in data['data']]
+            if not data['next_cursor']:
+                break
+            cursor = '&cursor=' + data['next_cursor']
+
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertGreaterEqual(len(ids), 3)
+
+    def test_422_search_articles_without_query(self):
+        res = self.client().get('/articles/search?q=', headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+
     # Test to Edit/Update Article
     def test_update_article(self):
         res = self.client().patch('/articles', json={'id': 23, 'title': 'LACTOSE TOLERANCE', 'date_created':
@@ -256,8 +604,444 @@ class CapstoneTest(unittest.TestCase):
         
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
-        
 
+    def test_422_duplicate_subscription(self):
+        body = {'nutritionist_id': 1, 'client_id': 1, 'subscription_status': True}
+        self.client().post('/subscriptions', json=body, headers=self.headers)
+        res = self.client().post('/subscriptions', json=body, headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    # Test to Subscribe in bulk
+    def test_bulk_subscription(self):
+        res = self.client().post('/subscriptions/bulk',
+                                 json=[{'nutritionist_id': 1, 'client_id': 1},
+                                       {'nutritionist_id': 1, 'client_id': 1},
+                                       {'nutritionist_id': 9999, 'client_id': 1}], headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['invalid'], 1)
+        self.assertEqual(data['created'] + data['duplicate'], 2)
+
+    # Test ids that aren't integers count as invalid
+    def test_bulk_subscription_rejects_bad_ids(self):
+        res = self.client().post('/subscriptions/bulk',
+                                 json=[{'nutritionist_id': [1], 'client_id': 1},
+                                       {'nutritionist_id': 1, 'client_id': {}},
+                                       {'nutritionist_id': 1, 'client_id': True}], headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['invalid'], 3)
+        self.assertEqual(data['created'], 0)
+
+    def test_412_subscription_unknown_client(self):
+        res = self.client().post('/subscriptions',
+                                 json={'nutritionist_id': 1, 'client_id': 9999, 'subscription_status': True}, headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 412)
+        self.assertEqual(data['success'], False)
+
+    '''
+        TEST FOR THE OUTBOX
+    '''
+
+    # Test the outbox worker fans a new article out to the client feed
+    def test_outbox_fans_out_new_article(self):
+        self.client().post('/articles',
+                           json={'nutritionist': 1, 'title': 'Outbox Article', 'content': 'Lorem Ipsume'}, headers=self.headers)
+        with self.app.app_context():
+            article = Article.query.filter(
+                Article.title == 'Outbox Article').order_by(
+                    Article.id.desc()).first()
+            queued = [json.loads(event.payload) for event in
+                      OutboxEvent.query.filter(
+                          OutboxEvent.topic == 'articles.created')]
+            self.assertIn({'ids': [article.id]}, queued)
+
+            while outbox.drain():
+                pass
+            self.assertEqual(ClientFeed.check(), (0, 0))
+
+    # Test a failing outbox event is kept for a later attempt
+    def test_outbox_retries_failed_event(self):
+        with self.app.app_context():
+            OutboxEvent.publish('unknown.topic')
+            db.session.commit()
+            while outbox.drain():
+                pass
+            event = OutboxEvent.query.filter(
+                OutboxEvent.topic == 'unknown.topic').order_by(
+                    OutboxEvent.id.desc()).first()
+
+            self.assertEqual(event.attempts, 1)
+            self.assertIn('KeyError', event.last_error)
+            self.assertIsNotNone(event.available_at)
+            db.session.delete(event)
+            db.session.commit()
+
+
+class JWKSCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.jwks = {'keys': [{'kid': 'key1', 'kty': 'RSA', 'use': 'sig',
+                               'n': 'abc', 'e': 'AQAB'}]}
+        self.fetches = 0
+
+    def fetch(self):
+        self.fetches += 1
+        return self.jwks
+
+    def test_keys_are_cached(self):
+        cache = JWKSCache('https://example.com/jwks.json')
+        cache._fetch = self.fetch
+        cache.get_key('key1')
+        cache.get_key('key1')
+
+        self.assertEqual(self.fetches, 1)
+        self.assertEqual(cache.get_key('key1')['n'], 'abc')
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        cache = JWKSCache('https://example.com/jwks.json',
+                          min_refresh_interval=60)
+        cache._fetch = self.fetch
+        for _ in range(5):
+            self.assertIsNone(cache.get_key('unknown'))
+
+        self.assertEqual(self.fetches, 1)
+
+    def test_keys_are_built_once_per_load(self):
+        built = []
+        cache = JWKSCache('https://example.com/jwks.json',
+                          key_builder=lambda key: built.append(key) or key['kid'])
+        cache._fetch = self.fetch
+        for _ in range(3):
+            self.assertEqual(cache.get_key('key1'), 'key1')
+
+        self.assertEqual(len(built), 1)
+
+
+class VerifyJWTTest(unittest.TestCase):
+    # A token signed with a real key, verified against the JWKS key cache
+    def setUp(self):
+        public, self.private = rsa.newkeys(1024)
+        self.jwks = {'keys': [{
+            'kid': 'test', 'kty': 'RSA', 'use': 'sig',
+            'n': self.b64_uint(public.n), 'e': self.b64_uint(public.e)}]}
+        self.cache = auth.auth.jwks_cache
+        auth.auth.jwks_cache = JWKSCache(
+            'https://example.com/jwks.json',
+            key_builder=auth.auth.build_public_key)
+        auth.auth.jwks_cache._fetch = lambda: self.jwks
+
+    def tearDown(self):
+        auth.auth.jwks_cache = self.cache
+
+    @staticmethod
+    def b64_uint(value):
+        raw = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+        return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+    def token(self, permissions):
+        claims = {'iss': 'https://{}/'.format(auth.auth.AUTH0_DOMAIN),
+                  'exp': int(time.time()) + 60, 'permissions': permissions}
+        if auth.auth.API_AUDIENCE:
+            claims['aud'] = auth.auth.API_AUDIENCE
+        return jwt.encode(claims, self.private.save_pkcs1().decode('ascii'),
+                          algorithm='RS256', headers={'kid': 'test'})
+
+    def test_signed_token_is_verified(self):
+        payload = auth.auth.verify_decode_jwt(self.token(['read:article']))
+
+        self.assertEqual(payload['permissions'], ['read:article'])
+
+    def test_requires_auth_admits_signed_token(self):
+        app = Flask(__name__)
+
+        @app.route('/')
+        @auth.auth.requires_auth('read:article')
+        def index(payload):
+            return 'ok'
+
+        res = app.test_client().get('/', headers={
+            'Authorization': 'Bearer ' + self.token(['read:article'])})
+
+        self.assertEqual(res.status_code, 200)
+
+
+class TokenCacheTest(unittest.TestCase):
+    def test_hit_returns_payload_and_permission_set(self):
+        cache = TokenCache(max_size=10)
+        payload = {'exp': time.time() + 60, 'permissions': ['read:article']}
+        cache.put('token', payload)
+        cached_payload, permissions = cache.get('token')
+
+        self.assertEqual(cached_payload, payload)
+        self.assertEqual(permissions, frozenset(['read:article']))
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_expired_token_is_a_miss(self):
+        cache = TokenCache(max_size=10)
+        cache.put('token', {'exp': time.time() - 1, 'permissions': []})
+
+        self.assertIsNone(cache.get('token'))
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_least_recently_used_token_is_evicted(self):
+        cache = TokenCache(max_size=2)
+        for token in ('a', 'b', 'c'):
+            cache.put(token, {'exp': time.time() + 60, 'permissions': []})
+
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('c'))
+
+
+class ReplicaRoutingTest(unittest.TestCase):
+    def test_round_robin_cycles_through_replicas(self):
+        replicas = ReplicaSet(['sqlite://', 'sqlite://'])
+        chosen = [replicas.choose() for _ in range(4)]
+
+        self.assertIs(chosen[0], replicas.engines[0])
+        self.assertIs(chosen[1], replicas.engines[1])
+        self.assertEqual(chosen[:2], chosen[2:])
+
+    def test_no_replicas_reads_from_primary(self):
+        replicas = ReplicaSet([])
+
+        self.assertFalse(replicas)
+        self.assertIsNone(replicas.choose())
+
+    def test_writer_is_pinned_for_the_window(self):
+        pins = PrimaryPins(window=5)
+        pins.pin('user|1', now=100)
+
+        self.assertTrue(pins.is_pinned('user|1', now=104))
+        self.assertFalse(pins.is_pinned('user|1', now=106))
+        self.assertFalse(pins.is_pinned('user|2', now=104))
+
+    def test_pin_is_shared_through_the_directory(self):
+        directory = tempfile.mkdtemp()
+        writer = PrimaryPins(window=5, directory=directory)
+        reader = PrimaryPins(window=5, directory=directory)
+        now = time.time()
+        writer.pin('user|1', now=now)
+
+        self.assertTrue(reader.is_pinned('user|1', now=now + 4))
+        self.assertFalse(reader.is_pinned('user|1', now=now + 6))
+        self.assertFalse(reader.is_pinned('user|2', now=now))
+        shutil.rmtree(directory)
+
+
+class ResourceVersionTest(unittest.TestCase):
+    def test_version_is_the_sum_of_its_slots(self):
+        earlier, later = datetime(2021, 1, 1), datetime(2021, 1, 2)
+        versions = ResourceVersion.combine(['articles', 'clients'], [
+            ('articles', 2, earlier),
+            (ResourceVersion.slot_key('articles', 3), 5, later)])
+
+        self.assertEqual(versions, {'articles': (7, later),
+                                    'clients': (0, None)})
+
+
+class CompressionTest(unittest.TestCase):
+    def test_streamed_chunks_are_flushed(self):
+        app = Flask(__name__)
+        chunks = [b'{"id": 1}\n', b'{"id": 2}\n']
+        with app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+            response = compress_response(app.response_class(
+                iter(chunks), mimetype='application/x-ndjson'))
+            decompressor = zlib.decompressobj(31)
+
+            # Each chunk decompresses on its own, without the next
+            for chunk, compressed in zip(chunks, response.response):
+                self.assertEqual(decompressor.decompress(compressed), chunk)
+
+
+    def test_encoding_follows_q_values(self):
+        app = Flask(__name__)
+        br = 'br' if compression.brotli else None
+        for header, encoding in (('br;q=0.1, gzip;q=1', 'gzip'),
+                                 ('gzip, br', br or 'gzip'),
+                                 ('gzip;q=0, br', br), ('gzip;q=0', None),
+                                 ('*;q=0.5', br or 'gzip'), ('', None)):
+            with app.test_request_context(
+                    headers={'Accept-Encoding': header}):
+                self.assertEqual(compression.choose_encoding(), encoding,
+                                 header)
+
+
+class MetricsRegistryTest(unittest.TestCase):
+    def test_request_fills_counter_and_histograms(self):
+        registry = Registry(buckets=(0.01, 0.1))
+        registry.observe_request('get_articles', 'GET', '200', 0.05,
+                                 {'db': 0.02})
+        registry.observe_request('get_articles', 'GET', '200', 0.5, {})
+
+        self.assertEqual(registry.counters[
+            'capstone_http_requests_total', ('get_articles', 'GET', '200')], 2)
+        # One request in (0.01, 0.1], one above every bucket
+        self.assertEqual(registry.histograms[
+            'capstone_http_request_duration_seconds',
+            ('get_articles', 'GET')][:3], [0, 1, 1])
+        self.assertEqual(registry.histograms[
+            'capstone_request_phase_duration_seconds',
+            ('get_articles', 'db')][:3], [0, 1, 0])
+
+    def test_timer_outside_hooks_survives_teardown(self):
+        app = Flask(__name__)
+        setup_metrics(app)
+        with app.test_request_context('/articles'):
+            timer = start_timer('get_articles', 'GET', hooks=False)
+
+        # asgi.py pushes several request contexts for one request
+        self.assertIs(current_timer.get(), timer)
+        end_timer()
+        self.assertIsNone(current_timer.get())
+
+
+class QueryProfileTest(unittest.TestCase):
+    def test_repeated_statements_are_flagged(self):
+        profile = QueryProfile('create_articles')
+        for _ in range(3):
+            profile.add('SELECT * FROM nutritionists WHERE id = %s', 0.001)
+        profile.add('INSERT INTO articles VALUES (%s)', 0.002)
+
+        self.assertEqual(profile.count, 4)
+        self.assertEqual(profile.repeated(threshold=3), [
+            ('SELECT * FROM nutritionists WHERE id = %s', 3)])
+
+    def test_keeps_the_slowest_statements(self):
+        profile = QueryProfile('get_articles', slowest=2)
+        for seconds in (0.003, 0.001, 0.005, 0.002):
+            profile.add('query {}'.format(seconds), seconds)
+
+        self.assertEqual([statement for statement, _ in profile.slowest()],
+                         ['query 0.005', 'query 0.003'])
+        self.assertAlmostEqual(profile.total, 0.011)
+
+
+class AdmissionControllerTest(unittest.TestCase):
+    def test_sheds_above_the_in_flight_limit(self):
+        controller = AdmissionController(max_in_flight=2)
+        controller.enter()
+        controller.enter()
+        self.assertTrue(controller.admit([]))
+
+        controller.enter()
+        self.assertFalse(controller.admit([]))
+        self.assertEqual(controller.stats(), {'in_flight': 3, 'shed': 1})
+
+        controller.leave()
+        self.assertTrue(controller.admit([]))
+
+    def test_sheds_after_a_long_queue(self):
+        controller = AdmissionController(max_in_flight=0, max_queue_ms=500)
+        now = time.time()
+        for header in ('t={}'.format(int(now * 1e6)), str(int(now * 1000)),
+                       't={:.3f}'.format(now)):
+            self.assertLess(queue_time({'X-Request-Start': header}), 0.5)
+        queued = queue_time({'X-Request-Start': str(int(now * 1000) - 2000)})
+
+        self.assertGreater(queued, 1.9)
+        self.assertFalse(controller.admit([], queued))
+        self.assertTrue(controller.admit([], queue_time({})))
+
+    def test_sheds_after_a_slow_checkout(self):
+        pool = TimedQueuePool(lambda: sqlite3.connect(':memory:'),
+                              pool_size=1, max_overflow=0, timeout=0.05)
+        controller = AdmissionController(max_in_flight=0,
+                                         max_pool_wait_ms=20)
+        connection = pool.connect()
+        self.assertTrue(controller.admit([pool]))
+
+        # The second checkout waits for the pool timeout
+        with self.assertRaises(exc.TimeoutError):
+            pool.connect()
+        self.assertEqual(pool.timeouts, 1)
+        self.assertFalse(controller.admit([pool]))
+        connection.close()
+
+
+class SyntheticDataTest(unittest.TestCase):
+    def test_same_seed_gives_same_rows(self):
+        plan = synthetic.Plan(seed=3, nutritionists=20, clients=50)
+        rows = list(synthetic.subscription_rows(plan, 0))
+
+        self.assertEqual(rows, list(synthetic.subscription_rows(
+            synthetic.Plan(seed=3, nutritionists=20, clients=50), 0)))
+        self.assertNotEqual(rows, list(synthetic.subscription_rows(
+            synthetic.Plan(seed=4, nutritionists=20, clients=50), 0)))
+
+    def test_articles_follow_the_distribution(self):
+        plan = synthetic.Plan(nutritionists=30, articles_per_nutritionist=4,
+                              article_distribution='constant')
+        rows = list(synthetic.article_rows(plan, 0))
+
+        self.assertEqual(len(rows), 120)
+        self.assertEqual({row[4] for row in rows}, set(range(1, 31)))
+        self.assertEqual([row[0] for row in rows], list(range(1, 121)))
+
+    def test_ids_do_not_depend_on_commit_order(self):
+        # Workers commit chunks in any order; loading them last to first
+        # must give the rows loading them in order does
+        directory = tempfile.mkdtemp()
+        chunk_size = synthetic.CHUNK_SIZE
+        synthetic.CHUNK_SIZE = 7
+        try:
+            loaded = []
+            for order in (list, lambda chunks: list(reversed(chunks))):
+                url = 'sqlite:///{}/{}.db'.format(directory, len(loaded))
+                engine = synthetic.create_engine(url)
+                db.Model.metadata.create_all(engine)
+                plan = synthetic.Plan(seed=5, nutritionists=20, clients=30,
+                                      articles_per_nutritionist=3)
+                with engine.begin() as connection:
+                    synthetic.prepare(connection, plan)
+                for table_name in ('nutritionists', 'clients', 'articles',
+                                   'subscriptions'):
+                    for chunk in order(synthetic.chunks(
+                            plan.entities(table_name))):
+                        synthetic.load_chunk((url, plan, table_name, chunk))
+                loaded.append([engine.execute(
+                    'SELECT * FROM {} ORDER BY id'.format(table)).fetchall()
+                    for table in ('articles', 'subscriptions')])
+                engine.dispose()
+        finally:
+            synthetic.CHUNK_SIZE = chunk_size
+            shutil.rmtree(directory)
+
+        self.assertTrue(loaded[0][0] and loaded[0][1])
+        self.assertEqual(loaded[0], loaded[1])
+
+    def test_unknown_distribution_is_rejected(self):
+        with self.assertRaises(ValueError):
+            synthetic.Plan(article_distribution='normal')
+
+
+@unittest.skipIf(asgi is None, 'ASGI extras are not installed')
+class AsgiTest(unittest.TestCase):
+    def test_query_numbers_placeholders_in_order(self):
+        query = asgi.Query('SELECT id FROM articles WHERE nutritionist_id = ')
+        query.sql += query.param(3) + ' LIMIT ' + query.param(51)
+
+        self.assertTrue(query.sql.endswith('= $1 LIMIT $2'))
+        self.assertEqual(query.params, [3, 51])
+
+    def test_environ_carries_path_query_and_headers(self):
+        environ = asgi.wsgi_environ({
+            'type': 'http', 'method': 'GET', 'path': '/articles',
+            'query_string': b'limit=5', 'http_version': '1.1',
+            'headers': [(b'authorization', b'Bearer abc'),
+                        (b'accept', b'application/json')]
+        })
+
+        self.assertEqual(environ['PATH_INFO'], '/articles')
+        self.assertEqual(environ['QUERY_STRING'], 'limit=5')
+        self.assertEqual(environ['HTTP_AUTHORIZATION'], 'Bearer abc')
 
 
 # Make the tests conveniently executable